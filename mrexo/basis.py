@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.special import gammaln, xlogy, xlog1py
+import sys
+if sys.version_info.major==3:
+    from functools import lru_cache
+else:
+    from functools32 import lru_cache
+
+
+@lru_cache(maxsize=200)
+def _log_beta_coefficients(deg, deg_vec):
+    """
+    Log of the normalizing constants of the beta densities used as the basis,
+    i.e. log(Gamma(deg+1) / (Gamma(d) * Gamma(deg-d+1))) for d in deg_vec.
+    Cached per degree, since the same coefficients are used for every data point.
+
+    INPUTS:
+        deg: Degree used for beta densities. Integer value.
+        deg_vec: Tuple of shape1 parameters (d) for the beta densities.
+    OUTPUT:
+        log_coefficients: Numpy array of the log normalizing constants.
+    """
+    d = np.array(deg_vec, dtype=float)
+    log_coefficients = gammaln(deg + 1) - gammaln(d) - gammaln(deg - d + 1)
+    log_coefficients.setflags(write=False)
+    return log_coefficients
+
+
+def beta_pdf_matrix(x, deg, deg_vec=None, return_log=False):
+    """
+    Evaluate the beta densities Beta(d, deg - d + 1), for each d in deg_vec, at an array of points.
+    Replaces the factorial based _beta_pdf(), and is stable for large degrees since everything
+    is computed in log space using log-gamma functions.
+
+    Refer to Ning et al. 2018 Sec 2.1, Eq 7.
+
+    INPUTS:
+        x: Numpy array (or scalar) of points scaled to [0, 1]. Density is zero outside [0, 1].
+        deg: Degree used for beta densities. Integer value.
+        deg_vec: Vector of shape1 parameters. Default=None. If None, uses 1 to deg.
+        return_log: If True, return the log of the densities (-np.inf where the density is zero).
+    OUTPUT:
+        beta_pdf: Numpy array of shape (len(x), len(deg_vec)) with the (log) densities.
+    """
+    if deg_vec is None:
+        deg_vec = np.arange(1, deg+1)
+    deg_vec = tuple(int(d) for d in np.atleast_1d(deg_vec))
+
+    x = np.atleast_1d(np.asarray(x, dtype=float))[:,None]
+    d = np.array(deg_vec, dtype=float)[None,:]
+
+    outside = (x < 0) | (x > 1)
+    x_clipped = np.clip(x, 0, 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pdf = _log_beta_coefficients(deg, deg_vec) + xlogy(d - 1, x_clipped) + xlog1py(deg - d, -x_clipped)
+    log_pdf = np.where(outside, -np.inf, log_pdf)
+
+    if return_log:
+        return log_pdf
+    return np.exp(log_pdf)
+
+
+def beta_cdf_matrix(x, deg, deg_vec=None):
+    """
+    Evaluate the CDFs of the beta densities Beta(d, deg - d + 1), for each d in deg_vec, at an array of points,
+    i.e. the regularized incomplete beta functions I_x(d, deg - d + 1).
+    All the degrees are found in a single pass from the recurrence
+        I_x(d, deg - d + 1) = I_x(d + 1, deg - d) + C(deg, d) * x**d * (1 - x)**(deg - d),
+    so each CDF is a cumulative sum of the Bernstein polynomials of degree deg, starting from d = deg.
+    The Bernstein polynomials are the beta densities of degree deg + 1 divided by deg + 1, and are
+    evaluated in log space by beta_pdf_matrix().
+
+    INPUTS:
+        x: Numpy array (or scalar) of points scaled to [0, 1]. The CDF is 0 below 0 and 1 above 1.
+        deg: Degree used for beta densities. Integer value.
+        deg_vec: Vector of shape1 parameters. Default=None. If None, uses 1 to deg.
+    OUTPUT:
+        beta_cdf: Numpy array of shape (len(x), len(deg_vec)) with the CDFs.
+    """
+    if deg_vec is None:
+        deg_vec = np.arange(1, deg+1)
+    deg_vec = np.atleast_1d(np.asarray(deg_vec, dtype=int))
+
+    x = np.clip(np.atleast_1d(np.asarray(x, dtype=float)), 0, 1)
+
+    # Bernstein polynomials C(deg, k) x**k (1 - x)**(deg - k), for k = 0 to deg
+    bernstein = beta_pdf_matrix(x, deg=deg+1) / (deg + 1)
+    beta_cdf = np.cumsum(bernstein[:,::-1], axis=1)[:,::-1]
+
+    return np.minimum(beta_cdf[:,deg_vec], 1)
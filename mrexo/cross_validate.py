@@ -2,14 +2,17 @@
 import numpy as np
 import os
 from multiprocessing import Pool
-from .mle_utils import MLE_fit, calc_C_matrix
+from .mle_utils import MLE_fit, calc_indv_pdf_degrees, _neg_log_likelihood_log, _seed_weights
 from .utils import _save_dictionary, _logging
 
 
 def run_cross_validation(Y, X, Y_sigma, X_sigma, Y_bounds, X_bounds,
                         X_char='x', Y_char='y',
                         degree_max=60, k_fold=10, degree_candidates=None,
-                        cores=1, save_path=os.path.dirname(__file__), abs_tol=1e-8, verbose=2):
+                        cores=1, save_path=os.path.dirname(__file__), abs_tol=1e-8, verbose=2,
+                        indv_pdf=None, sparse_threshold=None, precision='float64', cache_dir=None,
+                        solver='slsqp', solver_options=None, weights_init=None, active_set=False,
+                        compress_tol=None):
     """
     We use k-fold cross validation to choose the optimal number of degrees from a set of input candidate degree values.
     To conduct the k-fold cross validation, we separate the dataset randomly into k disjoint subsets with equal
@@ -50,12 +53,25 @@ def run_cross_validation(Y, X, Y_sigma, X_sigma, Y_bounds, X_bounds,
         If 0: Will not log in the log file or print statements.
         If 1: Will write log file only.
         If 2: Will write log file and print statements.
+        indv_pdf: Dictionary keyed by degree with the log of the integrated basis rows (Y_indv_pdf, X_indv_pdf)
+                for the whole dataset, as returned by calc_indv_pdf_degrees(return_log=True). Default is None.
+                If None, or if a degree candidate is missing, they are integrated here.
+        sparse_threshold: Truncation threshold for sparse beta densities in the training fits. See MLE_fit().
+        precision: 'float64' or 'float32'. Precision for the training fits. See MLE_fit().
+        cache_dir: Directory for the on-disk cache of integrated beta densities. See calc_indv_pdf().
+        solver: 'slsqp', 'trust-constr' or 'em'. Optimizer for the training fits. See MLE_fit().
+        solver_options: Dictionary of options for the solver. See MLE_fit().
+        weights_init: Dictionary with degrees as keys and weights fitted to the full dataset as values.
+            If given, the fits to each fold start from these weights (resampled from the nearest
+            degree for candidates not in the dictionary). Default=None, to start from uniform weights.
+        active_set: If True, use the active set mode for the training fits. See MLE_fit().
+        compress_tol: If not None, merge duplicate data points in the training fits. See MLE_fit().
 
     OUTPUTS:
 
         deg_choose - The optimum degree chosen by cross validation and MLE
     """
-    if degree_candidates == None:
+    if degree_candidates is None:
         degree_candidates = np.linspace(5, degree_max, 10, dtype = int)
 
     n = len(Y)
@@ -63,6 +79,19 @@ def run_cross_validation(Y, X, Y_sigma, X_sigma, Y_bounds, X_bounds,
     message = 'Running cross validation to estimate the number of degrees of freedom for the weights. Max candidate = {}\n'.format(degree_max)
     _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
+    Y_max = Y_bounds[1]
+    Y_min = Y_bounds[0]
+    X_max = X_bounds[1]
+    X_min = X_bounds[0]
+
+    # Integrate the basis rows for all the degree candidates for the whole dataset.
+    # Each fold then slices its training and test rows from these.
+    if indv_pdf is None or not all(d in indv_pdf for d in degree_candidates):
+        indv_pdf = calc_indv_pdf_degrees(n=n, degrees=degree_candidates, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                                X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
+                                abs_tol=abs_tol, save_path=save_path, Log=True, verbose=verbose, cores=cores,
+                                cache_dir=cache_dir, return_log=True)
+
     rand_gen = np.random.choice(n, n, replace = False)
     row_size = np.int(np.floor(n/k_fold))
     a = np.arange(n)
@@ -71,7 +100,9 @@ def run_cross_validation(Y, X, Y_sigma, X_sigma, Y_bounds, X_bounds,
     ## Map the inputs to the cross validation function. Then convert to numpy array and split in k_fold separate arrays
     # Iterator input to parallelize
     cv_input = ((i,j, indices_folded,n, rand_gen, Y, X, X_sigma, Y_sigma,
-     abs_tol, save_path, Y_bounds, X_bounds, Y_char, X_char, verbose) for i in range(k_fold) for j in degree_candidates)
+     abs_tol, save_path, Y_bounds, X_bounds, Y_char, X_char, verbose, indv_pdf[j], sparse_threshold, precision,
+     solver, solver_options, _seed_weights(weights_init, j), active_set, compress_tol)
+     for i in range(k_fold) for j in degree_candidates)
 
     # Run cross validation in parallel
     pool = Pool(processes = cores)
@@ -112,25 +143,28 @@ def _cv_parallelize(cv_input):
             save_path: Location of folder within results for auxiliary output files
             Y_bounds: Bounds for the Y. Log10
             X_bounds: Bounds for the X. Log10
+            indv_pdf: Tuple of (Y_indv_pdf, X_indv_pdf) integrated over the whole dataset for test_degree.
+            sparse_threshold: Truncation threshold for sparse beta densities. See MLE_fit().
+            precision: 'float64' or 'float32'. See MLE_fit().
+            solver: Optimizer for the weights. See MLE_fit().
+            solver_options: Dictionary of options for the solver. See MLE_fit().
+            weights_init: Initial weights for the training fit, or None. See MLE_fit().
+            active_set: If True, use the active set mode. See MLE_fit().
+            compress_tol: Tolerance for merging duplicate data points, or None. See MLE_fit().
 
     OUTPUT:
 
         like_pred : Predicted log likelihood for the i-th dataset and test_degree
     """
     i_fold, test_degree, indices_folded, n, rand_gen, Y, X, X_sigma, Y_sigma, abs_tol,\
-        save_path, Y_bounds, X_bounds, Y_char, X_char, verbose = cv_input
+        save_path, Y_bounds, X_bounds, Y_char, X_char, verbose, indv_pdf, sparse_threshold, precision, \
+        solver, solver_options, weights_init, active_set, compress_tol = cv_input
     split_interval = indices_folded[i_fold]
 
     mask = np.repeat(False, n)
     mask[rand_gen[split_interval]] = True
     invert_mask = np.invert(mask)
 
-    # Test dataset - sth subset.
-    test_X = X[mask]
-    test_Y = Y[mask]
-    test_X_sigma = X_sigma[mask]
-    test_Y_sigma = Y_sigma[mask]
-
     # Corresponding training dataset k-1 in size
     train_X = X[invert_mask]
     train_Y = Y[invert_mask]
@@ -140,26 +174,17 @@ def _cv_parallelize(cv_input):
     message='Running cross validation for {} degree check and {} th-fold\n'.format(test_degree, i_fold)
     _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
+    Y_indv_pdf, X_indv_pdf = indv_pdf
+
     # Calculate the optimum weights using MLE for a given input test_degree
     weights = MLE_fit(Y=train_Y, X=train_X, Y_sigma=train_Y_sigma, X_sigma=train_X_sigma,
             Y_bounds=Y_bounds, X_bounds=X_bounds, Y_char=Y_char, X_char=X_char,
-            deg=test_degree, abs_tol=abs_tol, save_path=save_path, output_weights_only=True, verbose=verbose)
-
-    size_test = np.size(test_X)
-
-    # Specify the bounds
-    Y_max = Y_bounds[1]
-    Y_min = Y_bounds[0]
-    X_max = X_bounds[1]
-    X_min = X_bounds[0]
-
-    print(size_test, len(Y_bounds))
-
-    # Integrate the product of the normal and beta distribution for Y and X and then take the Kronecker product
-    C_pdf = calc_C_matrix(size_test, test_degree, test_Y, test_Y_sigma, Y_max, Y_min, test_X,
-                        test_X_sigma, X_max, X_min,  abs_tol, save_path, Log=True, verbose=verbose)
+            deg=test_degree, abs_tol=abs_tol, save_path=save_path, output_weights_only=True, verbose=verbose,
+            indv_pdf=(Y_indv_pdf[invert_mask], X_indv_pdf[invert_mask]), sparse_threshold=sparse_threshold,
+            precision=precision, solver=solver, solver_options=solver_options, weights_init=weights_init,
+            active_set=active_set, compress_tol=compress_tol)
 
-    # Calculate the final loglikelihood
-    like_pred =  np.sum(np.log(np.matmul(weights,C_pdf)))
+    # Calculate the final loglikelihood from the already integrated test rows
+    like_pred = - _neg_log_likelihood_log(weights, Y_indv_pdf[mask], X_indv_pdf[mask])
 
     return like_pred
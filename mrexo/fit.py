@@ -4,8 +4,12 @@ from multiprocessing import Pool,cpu_count
 import os
 from astropy.table import Table
 import datetime
+import hashlib
+from collections import Counter
 
-from .mle_utils import MLE_fit
+from .mle_utils import MLE_fit, calc_indv_pdf, calc_indv_pdf_degrees, _neg_log_likelihood_log, _seed_weights
+from .mle_utils import _em_weights_batch, _initial_weights, _fit_output, _rescale_indv_pdf, _compress_rows
+from .mle_utils import calculate_joint_distribution_boot
 from .cross_validate import run_cross_validation
 from .utils import _save_dictionary, _logging
 
@@ -16,7 +20,10 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
                     Y_min=None, Y_max=None, X_min=None, X_max=None,
                     YSigmaLimit = 1e-3, XSigmaLimit = 1e-3,
                     select_deg=17, degree_max=None, k_fold=None, num_boot=100,
-                    cores=1, abs_tol=1e-8, verbose=2):
+                    cores=1, abs_tol=1e-8, verbose=2, sparse_threshold=None, precision='float64',
+                    cache_dir=None, solver='slsqp', solver_options=None, warm_start=True,
+                    batch_boot=True, active_set=False, compress_tol=None, incremental=False,
+                    joint_dist_size=100, joint_dist_boot=False):
     """
     Fit a Y and X relationship using a non parametric approach with beta densities
 
@@ -81,7 +88,7 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
         num_boot: Number of bootstraps to perform. Default=100. num_boot
                 must be greater than 1.
         cores: Number of cores for parallel processing. This is used in the
-               bootstrap and the cross validation. Default=1.
+               integration of the data points, the bootstrap and the cross validation. Default=1.
                To use all the cores in the CPU,
                cores=cpu_count() #from multiprocessing import cpu_count
         abs_tol: Absolute tolerance to be used for the numerical integration
@@ -91,6 +98,62 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
                     If 0: Will not log in the log file or print statements.
                     If 1: Will write log file only.
                     If 2: Will write log file and print statements.
+        sparse_threshold: If not None, store the integrated beta densities as sparse matrices
+                during the optimization, dropping entries smaller than sparse_threshold times
+                the largest entry for that data point. Eg. sparse_threshold=1e-10.
+                Default=None. See MLE_fit().
+        precision: 'float64' or 'float32'. Precision used for the beta densities in the
+                likelihood. Default='float64'. See MLE_fit().
+                If 'float32', the full dataset fit is repeated in float64, and the differences in
+                the weights, AIC and BIC are saved in other_data_products/precision_diagnostic.txt
+        cache_dir: Directory for a persistent on-disk cache of the integrated beta densities
+                for each data point. Refits of a catalog where most objects are unchanged
+                only integrate the new or changed objects. The rows derived for each degree
+                candidate are cached as well. Default=None, to use
+                output/other_data_products/indv_pdf_cache in save_path.
+        solver: 'slsqp', 'trust-constr' or 'em'. Optimizer used to find the weights for every fit
+                (degree selection, full dataset and bootstrap). Default='slsqp'. See MLE_fit().
+        solver_options: Dictionary of options for the solver. Default=None. See MLE_fit().
+        warm_start: If True, start the optimizer from weights that have already been fitted,
+                instead of uniform weights. The degree candidates are fitted in increasing
+                order, each starting from the previous degree's weights resampled onto its basis.
+                The cross validation folds start from the full dataset weights at the same degree,
+                and the bootstrap samples from the full dataset fit. Default=True.
+        batch_boot: If True, fit all the bootstrap samples at once with the batched EM solver
+                (_em_weights_batch()), since they share the integrated beta densities of the full
+                dataset and differ only in how many times each data point is drawn. solver_options are
+                also used for the batched EM solver. Only the conditional densities for each bootstrap
+                are then computed in parallel.
+                The batched solver is only used with solver='em', precision='float64', sparse_threshold=None
+                and active_set=False, so that the bootstraps are fitted with the same settings as the full
+                dataset. With any other settings, each bootstrap sample is fitted separately with MLE_fit(),
+                and this is noted in the log file.
+                If False, each bootstrap sample is fitted separately with MLE_fit(). Default=True.
+        active_set: If True, only optimize the weights which can be non-zero in each MLE_fit() call,
+                and check the optimality conditions for the rest at the end. Default=False. See MLE_fit().
+        compress_tol: If not None, merge data points with the same measurements and uncertainties
+                (binned with this width in dex if > 0), and weight each unique data point by its
+                multiplicity in the likelihood. Every fit, including each bootstrap resample, then
+                scales with the number of unique data points. Default=None. See MLE_fit().
+        incremental: If True and save_path has the results of an earlier fit, update that fit in place
+                instead of starting from zero, eg. after a few new objects are added to the table.
+                The degree selection is skipped and the earlier degree is used. The full dataset fit
+                starts from output/weights.txt, and the bootstrap fits from the rows of output/weights_boot.txt.
+                The earlier bounds are kept unless given, and only the new or changed data points are integrated,
+                since the earlier ones are in cache_dir.
+                Once the fit has finished, the added and removed data points are saved in input/XY_changes_<refit>.csv,
+                numbered by the refit, and a line with the number of changes and checksums of the old and new inputs
+                is added to input/refit_history.txt.
+                If there is no earlier fit, or the new data points fall outside the earlier bounds, a full
+                fit is run. Default=False.
+        joint_dist_size: Number of grid points along each axis for the joint distribution of the full dataset
+                fit (output/joint_distribution.txt), or a tuple of (number of X points, number of Y points).
+                Eg. 1000 for publication quality plots. Default=100.
+        joint_dist_boot: If True, also save the median, 16% and 84% quantiles of the joint distribution over the
+                bootstrap fits, on the same grid, to output/joint_distribution_boot.npy (shape 3 x Y points x X points).
+                The weights are streamed from output/weights_boot.txt and the grid is evaluated in tiles, so the
+                memory used does not grow with num_boot times the grid size. See calculate_joint_distribution_boot().
+                Default=False.
 
     OUTPUTS:
 
@@ -205,6 +268,13 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
     if not os.path.exists(input_location):
         os.mkdir(input_location)
 
+    if cache_dir is None:
+        cache_dir = os.path.join(aux_output_location, 'indv_pdf_cache')
+
+    previous_fit = None
+    if incremental:
+        previous_fit = _load_previous_fit(save_path)
+
     LabelDictionary = {'X_label':X_label, 'Y_label':Y_label, 'X_char': X_char, 'Y_char':Y_char}
     with open(os.path.join(aux_output_location, 'AxesLabels.txt'), 'w') as f:
         print(LabelDictionary, file=f)
@@ -232,6 +302,22 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
     if len(X) != len(X_sigma) and (X_sigma is not None):
         print('Length of X and X sigma vectors must be the same')
 
+    if previous_fit is not None:
+        # Keep the earlier bounds (so that the earlier weights stay valid) if they cover the new data.
+        covered = (np.log10(max(min(Y - Y_sigma), 0.01)) >= previous_fit['Y_bounds'][0]) & \
+                    (np.log10(max(Y + Y_sigma)) <= previous_fit['Y_bounds'][1]) & \
+                    (np.log10(min(np.abs(X - X_sigma))) >= previous_fit['X_bounds'][0]) & \
+                    (np.log10(max(X + X_sigma)) <= previous_fit['X_bounds'][1])
+        if covered or np.all([b is not None for b in [Y_min, Y_max, X_min, X_max]]):
+            Y_min = previous_fit['Y_bounds'][0] if Y_min is None else Y_min
+            Y_max = previous_fit['Y_bounds'][1] if Y_max is None else Y_max
+            X_min = previous_fit['X_bounds'][0] if X_min is None else X_min
+            X_max = previous_fit['X_bounds'][1] if X_max is None else X_max
+        else:
+            message = 'New data points are outside the bounds of the earlier fit. Running a full fit instead of an incremental fit.\n'
+            _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+            previous_fit = None
+
     if Y_min is None:
         if np.any(np.isnan(Y_sigma)):
             print('Provide {} Bounds'.format(Y_label))
@@ -269,6 +355,26 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
     ###########################################################
     ## Step 1: Select number of degrees based on cross validation (CV), AIC or BIC methods.
 
+    # Integrated basis rows for each degree, shared between the degree selection and the full dataset fit.
+    indv_pdf_per_degree = {}
+    # Weights fitted to the full dataset for each degree, used to seed later fits if warm_start.
+    weights_per_degree = {}
+
+    if previous_fit is not None:
+        # Reuse the degree of the earlier fit, and start from its weights.
+        message = 'Incremental fit: using the earlier degree = {}, and starting from the earlier weights\n'.format(previous_fit['deg'])
+        _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+        select_deg = previous_fit['deg']
+        weights_per_degree[previous_fit['deg']] = previous_fit['weights']
+
+    if select_deg in ['cv', 'aic', 'bic']:
+        # Integrate once at the largest degree candidate, and derive the rest from it.
+        degree_candidates = np.linspace(5, degree_max, 10, dtype = int)
+        indv_pdf_per_degree = calc_indv_pdf_degrees(n=n, degrees=degree_candidates, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                                    X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
+                                    abs_tol=abs_tol, save_path=aux_output_location, Log=True, verbose=verbose, cores=cores,
+                                    cache_dir=cache_dir, return_log=True)
+
     if select_deg == 'cv':
         # Use the CV method with training and test dataset to maximize log likelihood.
         if k_fold == None:
@@ -280,21 +386,47 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
         message = 'Picked {} k-folds'.format(k_fold)
         _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
+        if warm_start:
+            # Fit the full dataset at each degree candidate, to seed the fits to the folds.
+            for d in degree_candidates:
+                weights_per_degree[d] = MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
+                                X_char=X_char, Y_char=Y_char,
+                                Y_bounds=Y_bounds, X_bounds=X_bounds, deg=d, abs_tol=abs_tol,
+                                save_path=aux_output_location, output_weights_only=True, verbose=verbose,
+                                indv_pdf=indv_pdf_per_degree[d], sparse_threshold=sparse_threshold,
+                                precision=precision, solver=solver, solver_options=solver_options,
+                                weights_init=_seed_weights(weights_per_degree, d), active_set=active_set,
+                                compress_tol=compress_tol)
+
         deg_choose = run_cross_validation(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
                                         X_char=X_char, Y_char=Y_char,
                                         Y_bounds=Y_bounds, X_bounds=X_bounds,
-                                        degree_max=degree_max, k_fold=k_fold, cores=cores, save_path=aux_output_location, abs_tol=abs_tol, verbose=verbose)
+                                        degree_max=degree_max, k_fold=k_fold, degree_candidates=degree_candidates,
+                                        cores=cores, save_path=aux_output_location, abs_tol=abs_tol, verbose=verbose,
+                                        indv_pdf=indv_pdf_per_degree, sparse_threshold=sparse_threshold,
+                                        precision=precision, cache_dir=cache_dir,
+                                        solver=solver, solver_options=solver_options,
+                                        weights_init=weights_per_degree if warm_start else None,
+                                        active_set=active_set, compress_tol=compress_tol)
 
         message = 'Finished CV. Picked {} degrees by maximizing likelihood\n'.format(deg_choose)
         _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
     elif select_deg == 'aic' :
         # Minimize the AIC
-        degree_candidates = np.linspace(5, degree_max, 10, dtype = int)
-        aic = np.array([MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
-                        X_char=X_char, Y_char=Y_char,
-                        Y_bounds=Y_bounds, X_bounds=X_bounds, deg=d, abs_tol=abs_tol,
-                        save_path=aux_output_location, verbose=verbose)['aic'] for d in degree_candidates])
+        aic = []
+        for d in degree_candidates:
+            result = MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
+                            X_char=X_char, Y_char=Y_char,
+                            Y_bounds=Y_bounds, X_bounds=X_bounds, deg=d, abs_tol=abs_tol,
+                            save_path=aux_output_location, verbose=verbose,
+                            indv_pdf=indv_pdf_per_degree[d], sparse_threshold=sparse_threshold,
+                            precision=precision, solver=solver, solver_options=solver_options,
+                            weights_init=_seed_weights(weights_per_degree, d) if warm_start else None,
+                            active_set=active_set, compress_tol=compress_tol)
+            weights_per_degree[d] = result['weights']
+            aic.append(result['aic'])
+        aic = np.array(aic)
 
         deg_choose = degree_candidates[np.argmin(aic)]
 
@@ -306,11 +438,19 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
 
     elif select_deg == 'bic':
         # Minimize the BIC
-        degree_candidates = np.linspace(5, degree_max, 10, dtype = int)
-        bic = np.array([MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
-                        X_char=X_char, Y_char=Y_char,
-                        Y_bounds=Y_bounds, X_bounds=X_bounds, deg=d,
-                        abs_tol=abs_tol, save_path=aux_output_location, verbose=verbose)['bic'] for d in degree_candidates])
+        bic = []
+        for d in degree_candidates:
+            result = MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
+                            X_char=X_char, Y_char=Y_char,
+                            Y_bounds=Y_bounds, X_bounds=X_bounds, deg=d,
+                            abs_tol=abs_tol, save_path=aux_output_location, verbose=verbose,
+                            indv_pdf=indv_pdf_per_degree[d], sparse_threshold=sparse_threshold,
+                            precision=precision, solver=solver, solver_options=solver_options,
+                            weights_init=_seed_weights(weights_per_degree, d) if warm_start else None,
+                            active_set=active_set, compress_tol=compress_tol)
+            weights_per_degree[d] = result['weights']
+            bic.append(result['bic'])
+        bic = np.array(bic)
 
         deg_choose = degree_candidates[np.argmin(bic)]
 
@@ -337,15 +477,44 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
     message = 'Running full dataset MLE before bootstrap\n'
     _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
+    # Integrate the basis rows once for the full dataset (unless already done for the degree selection).
+    # The bootstrap resamples reuse these rows.
+    deg_choose = int(deg_choose)
+    if deg_choose in indv_pdf_per_degree:
+        Y_indv_pdf, X_indv_pdf = indv_pdf_per_degree[deg_choose]
+    else:
+        Y_indv_pdf, X_indv_pdf = calc_indv_pdf(n=n, deg=deg_choose, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                                    X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
+                                    abs_tol=abs_tol, save_path=aux_output_location, Log=True, verbose=verbose, cores=cores,
+                                    cache_dir=cache_dir, return_log=True)
+
     initialfit_result = MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
                             Y_bounds=Y_bounds, X_bounds=X_bounds,
                             X_char=X_char, Y_char=Y_char,
-                            deg=int(deg_choose), abs_tol=abs_tol, save_path=aux_output_location,
-                            calc_joint_dist = True, verbose=verbose)
+                            deg=deg_choose, abs_tol=abs_tol, save_path=aux_output_location,
+                            calc_joint_dist = True, joint_dist_size=joint_dist_size, verbose=verbose,
+                            indv_pdf=(Y_indv_pdf, X_indv_pdf), sparse_threshold=sparse_threshold,
+                            precision=precision, solver=solver, solver_options=solver_options,
+                            weights_init=_seed_weights(weights_per_degree, deg_choose) if warm_start else None,
+                            active_set=active_set, compress_tol=compress_tol)
 
     message = 'Finished full dataset MLE run at {}\n'.format(datetime.datetime.now())
     _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
+    if precision != 'float64':
+        # Compare against a float64 reference fit, to check the reduced precision fit.
+        reference_weights = MLE_fit(Y=Y, X=X, Y_sigma=Y_sigma, X_sigma=X_sigma,
+                            Y_bounds=Y_bounds, X_bounds=X_bounds,
+                            X_char=X_char, Y_char=Y_char,
+                            deg=deg_choose, abs_tol=abs_tol, save_path=aux_output_location,
+                            output_weights_only=True, verbose=verbose,
+                            indv_pdf=(Y_indv_pdf, X_indv_pdf), sparse_threshold=sparse_threshold,
+                            precision='float64', solver=solver, solver_options=solver_options,
+                            active_set=active_set, compress_tol=compress_tol)
+        _precision_diagnostic(weights=initialfit_result['weights'], reference_weights=reference_weights,
+                            indv_pdf=(Y_indv_pdf, X_indv_pdf), deg=deg_choose, precision=precision,
+                            save_path=aux_output_location, verbose=verbose)
+
     _save_dictionary(dictionary=initialfit_result, output_location=output_location, bootstrap=False,
                     X_char=X_char, Y_char=Y_char, X_label=X_label, Y_label=Y_label)
 
@@ -354,30 +523,95 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
     if num_boot == 0:
         message='Bootstrap not run since num_boot = 0'
         _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+        if previous_fit is not None:
+            _record_input_changes(previous_fit['inputs'], t, input_location=input_location, deg=deg_choose,
+                                num_boot=num_boot, save_path=aux_output_location, verbose=verbose)
         return initialfit_result
     else:
-        # Generate iterator for using multiprocessing Pool.imap
-        n_boot_iter = (np.random.choice(n, n, replace=True) for i in range(num_boot))
-        inputs = ((Y[n_boot], X[n_boot], Y_sigma[n_boot], X_sigma[n_boot], Y_char, X_char,
-                Y_bounds, X_bounds, deg_choose, abs_tol, aux_output_location, verbose) for n_boot in n_boot_iter)
-
         message = '\n\n==============\nRunning {} bootstraps for the MLE code with degree = {}, using {} thread/s.\n==============\n\n'.format(str(num_boot),
                     str(deg_choose),str(cores))
         _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
-
-
-        # Parallelize the bootstraps
         pool = Pool(processes=cores)
-        bootstrap_results = list(pool.imap(_bootsample_mle,inputs))
+
+        # Starting weights for each bootstrap sample: the full dataset fit, or for an incremental fit
+        # the bootstrap weights of the earlier fit (reused in turn if there are more bootstraps now).
+        if not warm_start:
+            boot_weights_init = [None]*num_boot
+        elif previous_fit is not None and previous_fit['weights_boot'] is not None:
+            boot_weights_init = [previous_fit['weights_boot'][i % len(previous_fit['weights_boot'])] for i in range(num_boot)]
+        else:
+            boot_weights_init = [initialfit_result['weights']]*num_boot
+
+        if batch_boot and not (solver == 'em' and precision == 'float64' and sparse_threshold is None and not active_set):
+            message = "Fitting each bootstrap sample separately, since the batched bootstrap fits only support solver='em', precision='float64', sparse_threshold=None and active_set=False\n"
+            _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+            batch_boot = False
+
+        if batch_boot:
+            # Number of times each data point is drawn in each bootstrap sample
+            counts = np.array([np.bincount(np.random.choice(n, n, replace=True), minlength=n) for i in range(num_boot)])
+
+            if warm_start:
+                w0 = np.array([_initial_weights(w, deg_choose) for w in boot_weights_init])
+            else:
+                w0 = np.repeat(1./((deg_choose-2)**2),(deg_choose-2)**2)
+
+            Y_boot_pdf, X_boot_pdf = Y_indv_pdf, X_indv_pdf
+            if compress_tol is not None:
+                # Add up the counts of the merged data points, and fit the unique data points only
+                unique_idx, inverse, _ = _compress_rows(Y, Y_sigma, X, X_sigma, compress_tol=compress_tol, Log=True)
+                counts = np.array([np.bincount(inverse, weights=c, minlength=len(unique_idx)) for c in counts])
+                Y_boot_pdf, X_boot_pdf = Y_indv_pdf[unique_idx], X_indv_pdf[unique_idx]
+
+            # The EM updates use the rescaled rows, and the row scales are added back to the log likelihood.
+            Y_scaled, Y_log_scale = _rescale_indv_pdf(Y_boot_pdf)
+            X_scaled, X_log_scale = _rescale_indv_pdf(X_boot_pdf)
+            boot_weights, boot_n_log_lik, n_iter, converged = _em_weights_batch(w0, Y_scaled, X_scaled, counts,
+                                        **(solver_options or {}))
+            boot_n_log_lik = boot_n_log_lik - counts.dot(Y_log_scale + X_log_scale)
+
+            message = 'Finished batched bootstrap fits at {}. {} of {} converged, with up to {} iterations.\n'.format(
+                        datetime.datetime.now(), np.sum(converged), num_boot, np.max(n_iter))
+            _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+
+            inputs = ((boot_weights[i], boot_n_log_lik[i], n, deg_choose, Y_bounds, X_bounds, abs_tol)
+                    for i in range(num_boot))
+            bootstrap_results = list(pool.imap(_bootsample_output,inputs))
+
+        else:
+            # Generate iterator for using multiprocessing Pool.imap
+            n_boot_iter = (np.random.choice(n, n, replace=True) for i in range(num_boot))
+            inputs = ((Y[n_boot], X[n_boot], Y_sigma[n_boot], X_sigma[n_boot], Y_char, X_char,
+                    Y_bounds, X_bounds, deg_choose, abs_tol, aux_output_location, verbose,
+                    (Y_indv_pdf[n_boot], X_indv_pdf[n_boot]), sparse_threshold, precision,
+                    solver, solver_options, weights_init, active_set,
+                    compress_tol)
+                    for n_boot, weights_init in zip(n_boot_iter, boot_weights_init))
+
+            # Parallelize the bootstraps
+            bootstrap_results = list(pool.imap(_bootsample_mle,inputs))
 
         _save_dictionary(dictionary=bootstrap_results, output_location=output_location, bootstrap=True,
                             X_char=X_char, Y_char=Y_char, X_label=X_label, Y_label=Y_label)
 
+        if joint_dist_boot:
+            X_size, Y_size = np.broadcast_to(joint_dist_size, 2).astype(int)
+            _ = calculate_joint_distribution_boot(os.path.join(output_location,'weights_boot.txt'),
+                                        np.linspace(X_min, X_max, X_size), X_min, X_max,
+                                        np.linspace(Y_min, Y_max, Y_size), Y_min, Y_max,
+                                        filename=os.path.join(output_location,'joint_distribution_boot.npy'))
+            message = 'Saved the bootstrap quantiles (50%, 16%, 84%) of the joint distribution at {}\n'.format(datetime.datetime.now())
+            _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
+
 
         message = 'Finished bootstrap at {}'.format(datetime.datetime.now())
         _ = _logging(message=message, filepath=aux_output_location, verbose=verbose, append=True)
 
+        if previous_fit is not None:
+            _record_input_changes(previous_fit['inputs'], t, input_location=input_location, deg=deg_choose,
+                                num_boot=num_boot, save_path=aux_output_location, verbose=verbose)
+
 
         endtime = datetime.datetime.now()
         print(endtime - starttime)
@@ -403,6 +637,96 @@ def fit_xy_relation(Y, Y_sigma, X, X_sigma, save_path,
         return initialfit_result, bootstrap_results
 
 
+def _load_previous_fit(save_path):
+    """
+    Load the inputs and weights of an earlier fit saved by fit_xy_relation(), for an incremental fit.
+    \nINPUTS:
+        save_path: Folder with the results of the earlier fit.
+    OUTPUTS:
+
+        previous_fit: Dictionary with the keys below, or None if save_path has no earlier fit.
+                'inputs' : astropy Table of the earlier inputs (XY_inputs.csv).
+                'Y_bounds', 'X_bounds' : Bounds of the earlier fit (log10).
+                'weights' : Weights (deg**2) of the earlier full dataset fit.
+                'weights_boot' : Numpy array with the weights of each earlier bootstrap, or None.
+                'deg' : Degree of the earlier fit.
+    """
+    input_location = os.path.join(save_path, 'input')
+    output_location = os.path.join(save_path, 'output')
+
+    files = [os.path.join(input_location, 'XY_inputs.csv'), os.path.join(input_location, 'Y_bounds.txt'),
+            os.path.join(input_location, 'X_bounds.txt'), os.path.join(output_location, 'weights.txt')]
+    if not all(os.path.exists(f) for f in files):
+        return None
+
+    weights = np.loadtxt(os.path.join(output_location, 'weights.txt'))
+    weights_boot = None
+    if os.path.exists(os.path.join(output_location, 'weights_boot.txt')):
+        weights_boot = np.atleast_2d(np.loadtxt(os.path.join(output_location, 'weights_boot.txt')))
+
+    return {'inputs': Table.read(files[0]),
+            'Y_bounds': np.loadtxt(files[1]), 'X_bounds': np.loadtxt(files[2]),
+            'weights': weights, 'weights_boot': weights_boot,
+            'deg': int(round(np.sqrt(np.size(weights))))}
+
+
+def _record_input_changes(previous_inputs, inputs, input_location, deg, num_boot, save_path, verbose):
+    """
+    Record how the inputs of a finished incremental fit differ from those of the earlier fit.
+    The data points (rows of measurements and uncertainties) which were added or removed are saved in
+    XY_changes_<refit>.csv, with a 'change' column, where <refit> numbers the refits recorded in
+    refit_history.txt (starting at 1). A line with the refit number, the time, the number of data points
+    before and after, the number added and removed, the degree, the number of bootstraps and SHA1 checksums
+    of the earlier and new inputs is added to refit_history.txt.
+    \nINPUTS:
+        previous_inputs: astropy Table of the earlier inputs.
+        inputs: astropy Table of the new inputs, with the same columns.
+        input_location: Folder to save the files in.
+        deg: Degree of the fit.
+        num_boot: Number of bootstraps.
+        save_path: Folder with the log file.
+        verbose: Keyword specifying verbosity
+    OUTPUTS:
+
+        added, removed: Number of data points added and removed.
+    """
+    def as_rows(table):
+        # Same formatting as the csv file, so that the values read back from it compare equal.
+        return [tuple(repr(float(v)) for v in row) for row in np.array(table.as_array().tolist(), dtype=float)]
+
+    def checksum(table):
+        return hashlib.sha1(np.array(table.as_array().tolist(), dtype=float).tobytes()).hexdigest()
+
+    previous_rows, rows = Counter(as_rows(previous_inputs)), Counter(as_rows(inputs))
+    added = list((rows - previous_rows).elements())
+    removed = list((previous_rows - rows).elements())
+
+    history_file = os.path.join(input_location, 'refit_history.txt')
+    refit = 1
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            refit += sum(1 for line in f if line.strip() and not line.startswith('#'))
+    timestamp = datetime.datetime.now().isoformat()
+
+    changes = Table(rows=[[float(v) for v in row] + [c] for row, c in
+                            [(r, 'added') for r in added] + [(r, 'removed') for r in removed]] or None,
+                    names=list(inputs.colnames) + ['change'],
+                    dtype=[float]*len(inputs.colnames) + [str])
+    changes.write(os.path.join(input_location, 'XY_changes_{}.csv'.format(refit)), overwrite=True)
+
+    with open(history_file, 'a') as f:
+        if f.tell() == 0:
+            print('# refit, time, n_previous, n, added, removed, degree, num_boot, sha1_previous_inputs, sha1_inputs', file=f)
+        print('{}, {}, {}, {}, {}, {}, {}, {}, {}, {}'.format(refit, timestamp, len(previous_inputs), len(inputs), len(added),
+                len(removed), deg, num_boot, checksum(previous_inputs), checksum(inputs)), file=f)
+
+    message = 'Incremental fit: {} data points added and {} removed since the earlier fit. Saved in XY_changes_{}.csv\n'.format(
+                len(added), len(removed), refit)
+    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+
+    return len(added), len(removed)
+
+
 def _bootsample_mle(inputs):
     """
     To bootstrap the data and run MLE. Serves as input to the parallelizing function.
@@ -424,6 +748,15 @@ def _bootsample_mle(inputs):
                              Default : 1e-8
                     save_path: Folder name (+path) to save results in. Eg. save_path='~/mrexo_working/trial_result'
                     verbose: Keyword specifying verbosity
+                    indv_pdf: Tuple of the log (Y_indv_pdf, X_indv_pdf) rows for the resampled data points,
+                            indexed from the full dataset integrals.
+                    sparse_threshold: Truncation threshold for sparse beta densities. See MLE_fit().
+                    precision: 'float64' or 'float32'. See MLE_fit().
+                    solver: Optimizer for the weights. See MLE_fit().
+                    solver_options: Dictionary of options for the solver. See MLE_fit().
+                    weights_init: Initial weights (the full dataset fit), or None. See MLE_fit().
+                    active_set: If True, use the active set mode. See MLE_fit().
+                    compress_tol: Tolerance for merging duplicate data points, or None. See MLE_fit().
     OUTPUTS:
 
         XY_boot :Output dictionary from bootstrap run using Maximum Likelihood Estimation. Its keys are  -
@@ -447,6 +780,72 @@ def _bootsample_mle(inputs):
                     Y_char=inputs[4], X_char=inputs[5],
                     Y_bounds=inputs[6], X_bounds=inputs[7],
                     deg=inputs[8],
-                    abs_tol=inputs[9], save_path=inputs[10], verbose=inputs[11])
+                    abs_tol=inputs[9], save_path=inputs[10], verbose=inputs[11],
+                    indv_pdf=inputs[12], sparse_threshold=inputs[13], precision=inputs[14],
+                    solver=inputs[15], solver_options=inputs[16], weights_init=inputs[17],
+                    active_set=inputs[18], compress_tol=inputs[19])
 
     return XY_boot
+
+
+def _bootsample_output(inputs):
+    """
+    Build the output dictionary for a bootstrap sample fitted by the batched EM solver.
+    Serves as input to the parallelizing function.
+    \nINPUTS:
+        inputs : Tuple with the following components:
+                    weights: Fitted weights ((deg-2)**2) for the bootstrap sample.
+                    n_log_lik: Negative log likelihood of the bootstrap sample.
+                    n: Number of data points in the bootstrap sample.
+                    deg: Degree chosen for the beta densities.
+                    Y_bounds: Bounds for the Y.
+                    X_bounds: Bounds for the X.
+                    abs_tol: Absolute tolerance. See MLE_fit().
+    OUTPUTS:
+        XY_boot : Output dictionary from bootstrap run. Same keys as _bootsample_mle().
+    """
+    weights, n_log_lik, n, deg, Y_bounds, X_bounds, abs_tol = inputs
+
+    XY_boot = _fit_output(unpadded_weight=weights, n_log_lik=n_log_lik, n=n, deg=deg,
+                        Y_bounds=Y_bounds, X_bounds=X_bounds, abs_tol=abs_tol)
+
+    return XY_boot
+
+
+def _precision_diagnostic(weights, reference_weights, indv_pdf, deg, precision, save_path, verbose):
+    """
+    Compare a reduced precision fit with a float64 reference fit on the same data.
+    The log likelihood for both sets of weights is evaluated in float64.
+    \nINPUTS:
+        weights: Padded weights (deg**2) from the reduced precision fit.
+        reference_weights: Unpadded weights ((deg-2)**2) from the float64 fit.
+        indv_pdf: Tuple of the log of (Y_indv_pdf, X_indv_pdf) used for both the fits.
+        deg: Degree used for the beta densities.
+        precision: Precision of the reduced precision fit, used for the header.
+        save_path: Folder to save precision_diagnostic.txt in.
+        verbose: Keyword specifying verbosity
+    OUTPUTS:
+
+        diagnostic: Numpy array with the maximum absolute difference in weights,
+                AIC and BIC for the reduced precision fit, and AIC and BIC for the float64 fit.
+    """
+    n = np.shape(indv_pdf[0])[0]
+    weights = np.reshape(weights, (deg, deg))[1:-1,1:-1].flatten()
+
+    n_log_lik = _neg_log_likelihood_log(weights, *indv_pdf)
+    n_log_lik_reference = _neg_log_likelihood_log(reference_weights, *indv_pdf)
+
+    aic = n_log_lik*2 + 2*(deg**2 - 1)
+    bic = n_log_lik*2 + np.log(n)*(deg**2 - 1)
+    aic_reference = n_log_lik_reference*2 + 2*(deg**2 - 1)
+    bic_reference = n_log_lik_reference*2 + np.log(n)*(deg**2 - 1)
+
+    diagnostic = np.array([np.max(np.abs(weights - reference_weights)), aic, bic, aic_reference, bic_reference])
+    np.savetxt(os.path.join(save_path, 'precision_diagnostic.txt'), diagnostic, comments='#',
+            header='Comparison of {} fit with float64 reference fit. Rows: Max absolute weight difference, AIC ({}), BIC ({}), AIC (float64), BIC (float64)'.format(precision, precision, precision))
+
+    message = 'Precision diagnostic: Max weight difference = {:.3e}, AIC = {:.4f} ({}) vs {:.4f} (float64), BIC = {:.4f} ({}) vs {:.4f} (float64)\n'.format(
+                diagnostic[0], aic, precision, aic_reference, bic, precision, bic_reference)
+    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+
+    return diagnostic
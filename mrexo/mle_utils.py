@@ -1,14 +1,29 @@
 import numpy as np
-from scipy.stats import beta,norm
+from scipy.stats import norm
 import scipy
 from scipy.integrate import quad
-from scipy.optimize import brentq as root
-from scipy.optimize import fmin_slsqp, minimize
+from scipy.optimize import minimize
+import scipy.sparse
+from scipy.special import logsumexp
 import datetime,os
-from multiprocessing import current_process
+import shutil, tempfile
+from multiprocessing import current_process, Pool, RawArray
 
 
-from mrexo.utils import _logging
+from mrexo.utils import _logging, _basis_cache_keys, _load_cached_rows, _save_cached_rows, _cache_locations
+from mrexo.basis import beta_pdf_matrix, beta_cdf_matrix
+from mrexo.solvers import minimize_weights, SOLVERS, _solve_em
+
+# Active set mode in MLE_fit(): Number of EM updates used to screen for negligible weights,
+# tolerance on the duality gap of the pruned weights, and maximum number of rounds of adding back weights.
+_ACTIVE_SET_SCREEN_ITER = 50
+_ACTIVE_SET_KKT_TOL = 1e-3
+_ACTIVE_SET_MAX_ROUNDS = 10
+
+# Maximum number of elements in the temporary arrays of _conditional_quantiles() (the CDF grid, and the beta
+# densities at every quantile for the Newton steps). The conditioning values are processed in blocks to stay below
+# this, so the memory used (~32 MB per float64 array) does not grow with their number.
+_QUANTILE_BLOCK_ELEMENTS = 2**22
 
 
 ########################################
@@ -18,7 +33,10 @@ from mrexo.utils import _logging
 def MLE_fit(X, X_sigma, Y, Y_sigma,
             X_bounds, Y_bounds, Y_char, X_char,
             deg, Log=True, abs_tol=1e-8, output_weights_only=False,
-            save_path=None, calc_joint_dist = False, verbose=2):
+            save_path=None, calc_joint_dist = False, joint_dist_size=100, verbose=2,
+            indv_pdf=None, cores=1, sparse_threshold=None, precision='float64', cache_dir=None,
+            solver='slsqp', solver_options=None, weights_init=None, active_set=False,
+            callback=None, record_trace=False, minibatch_size=None, minibatch_options=None, compress_tol=None):
     '''
     Perform maximum likelihood estimation to find the weights for the beta density basis functions.
     Also, use those weights to calculate the conditional density distributions.
@@ -47,10 +65,73 @@ def MLE_fit(X, X_sigma, Y, Y_sigma,
         save_path: Location of folder for auxiliary output files.
         calc_joint_dist: If True, will calculate and output the
             joint distribution of Y and X.
+        joint_dist_size: Number of grid points along each axis for the joint distribution, or a tuple of
+            (number of X points, number of Y points). Default=100.
         verbose: Integer specifying verbosity for logging.
                 If 0: Will not log in the log file or print statements.
                 If 1: Will write log file only.
                 If 2: Will write log file and print statements.
+        indv_pdf: Tuple of (Y_indv_pdf, X_indv_pdf), the log of the integrated beta densities
+            for each data point from calc_indv_pdf(return_log=True). Default=None.
+            If given, the integration is skipped and these rows are used instead.
+            Used to reuse the full dataset integrals for the bootstrap resamples.
+        cores: Number of cores used to integrate the data points in parallel. Default=1.
+        sparse_threshold: If not None, store the integrated beta densities as sparse matrices,
+            dropping the entries smaller than sparse_threshold times the largest entry in that row.
+            Useful for high degree fits where the measurement uncertainties are small compared to the
+            width of the beta densities. The truncated fraction is reported in the log file. Default=None.
+        precision: 'float64' or 'float32'. Default='float64'.
+            The integrated beta densities are always rescaled (in log space) so that the largest entry for
+            each data point is 1, and the row scales are added back to the log likelihood. So the likelihood
+            of a data point far from every basis density does not underflow to zero.
+            If 'float32', the rescaled densities are stored in single precision.
+        cache_dir: Directory for the on-disk cache of integrated beta densities. See calc_indv_pdf().
+            Default=None (no cache).
+        solver: Optimizer used to find the weights. One of solvers.SOLVERS. Default='slsqp'.
+            'slsqp': Sequential least squares (scipy.optimize.fmin_slsqp), limited to 250 iterations.
+            'trust-constr': Trust region Newton method, using the exact Hessian vector product.
+            'em': Expectation maximization (multiplicative) updates for the mixture weights.
+                Monotone, needs no step size, and stays on the simplex. See solvers._solve_em().
+        solver_options: Dictionary of options for the solver. Default=None. See solvers.minimize_weights().
+            'slsqp': 'iter' (250), 'acc' (1e-5), 'epsilon' (1e-5), 'iprint' (1).
+            'trust-constr': 'maxiter' (1000), 'gtol' (1e-8), 'xtol' (1e-10), 'verbose' (0).
+            'em': 'tol' (1e-6): Stop when the log likelihood is within tol of its maximum (using the
+                duality gap as the bound), 'max_iter' (10000), 'acceleration' ('squarem' or None).
+        weights_init: Initial weights for the optimizer, eg. from a fit to the full dataset when
+            fitting a bootstrap sample or a cross validation fold. Either the padded weights (deg**2)
+            or the unpadded weights ((deg-2)**2). Use _resample_weights() to seed from a fit with
+            a different degree. Default=None, to start from uniform weights.
+        active_set: If True, only optimize the weights of basis functions which can be non-zero.
+            A few EM updates first identify the basis functions whose weights are negligible and whose
+            gradient shows that increasing them would decrease the likelihood. These are fixed at zero,
+            and the solver runs on the remaining weights. At the end, the optimality (KKT) conditions
+            are checked for the pruned weights; any that fail are added back and the fit is repeated.
+            Speeds up the fits at high degree, where most weights are zero. Default=False.
+        callback: Function called after every solver iteration as
+            callback(iteration, objective, duality_gap, wall_time). Default=None.
+        record_trace: If True, record the objective, duality gap and wall time at every solver iteration.
+            The trace is written to the log file, and returned as 'solver_trace' in the output dictionary.
+            Default=False.
+        minibatch_size: If not None, fit the weights with stepwise (online) EM, streaming the data points
+            in chunks of minibatch_size instead of evaluating the full likelihood at every step.
+            The integrated beta densities are computed one chunk at a time and kept in a temporary
+            memory mapped file in save_path, so the memory used does not grow with the number of data points.
+            Meant for catalogs of ~10^5 objects. solver, weights_init, active_set, sparse_threshold and
+            precision are not used. If compress_tol is given, the unique data points are streamed, each
+            weighted by its multiplicity. See _minibatch_em_weights(). Default=None.
+            Only available through MLE_fit(), since fit_xy_relation() keeps the integrated beta densities
+            of the full dataset in memory for the degree selection and the bootstraps.
+        minibatch_options: Dictionary of options for the stepwise EM. Default=None.
+            'holdout_size' (minibatch_size): Number of data points held out to check convergence.
+            'tol' (1e-6): Stop when the mean held out log likelihood changes by less than tol over an epoch.
+            'max_epochs' (100): Maximum number of passes over the data.
+            'step_exponent' (0.6): Exponent for the decay of the step size. Between 0.5 and 1.
+        compress_tol: If not None, merge data points with the same measurements and uncertainties before
+            fitting, and weight each unique data point by its multiplicity in the likelihood. Integration and
+            optimization then scale with the number of unique data points, eg. for bootstrap resamples.
+            If 0, only exact duplicates are merged. If > 0, the measurements and uncertainties are binned
+            with this width (in dex if Log=True), and the data points in a bin are represented by the first
+            of them. See _compress_rows(). Default=None.
 
     \nOUTPUT:
 
@@ -82,6 +163,9 @@ def MLE_fit(X, X_sigma, Y, Y_sigma,
 
                 if calc_joint_dist == True:
                 'joint_dist' : Joint distribution of Y AND X.
+                if record_trace == True:
+                'solver_trace' : Array with the iteration number, objective, duality gap
+                    and wall time (s) for every solver iteration.
     EXAMPLE:
 
             result = MLE_fit(y=Y, x=X, Y_sigma=Y_sigma,
@@ -105,114 +189,439 @@ def MLE_fit(X, X_sigma, Y, Y_sigma,
     X_max = X_bounds[1]
     X_min = X_bounds[0]
 
+    # Multiplicity of each data point in the likelihood
+    counts = None
+    if compress_tol is not None:
+        unique_idx, inverse, counts = _compress_rows(Y, Y_sigma, X, X_sigma, compress_tol=compress_tol, Log=Log)
+        Y, Y_sigma, X, X_sigma = Y[unique_idx], Y_sigma[unique_idx], X[unique_idx], X_sigma[unique_idx]
+        if indv_pdf is not None:
+            indv_pdf = (indv_pdf[0][unique_idx], indv_pdf[1][unique_idx])
+
+        message = 'Compressed {} data points to {} unique data points with compress_tol = {}\n'.format(n, len(unique_idx), compress_tol)
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+
+    if minibatch_size is not None:
+        unpadded_weight, n_log_lik = _minibatch_fit(deg=deg, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                                        X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min, abs_tol=abs_tol, Log=Log,
+                                        save_path=save_path, verbose=verbose, indv_pdf=indv_pdf, cores=cores,
+                                        cache_dir=cache_dir, minibatch_size=minibatch_size,
+                                        minibatch_options=minibatch_options, counts=counts)
+        if output_weights_only == True:
+            return unpadded_weight
+        return _fit_output(unpadded_weight=unpadded_weight, n_log_lik=n_log_lik, n=n, deg=deg,
+                        Y_bounds=Y_bounds, X_bounds=X_bounds, abs_tol=abs_tol, calc_joint_dist=calc_joint_dist,
+                        joint_dist_size=joint_dist_size)
+
     ########################################################################
     # Integration to find C matrix (input for log likelihood maximization.)
     ########################################################################
-    C_pdf = calc_C_matrix(n=n, deg=deg, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
-                        X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
-                        Log=Log, abs_tol=abs_tol, save_path=save_path, verbose=verbose)
+    if indv_pdf is None:
+        indv_pdf = calc_indv_pdf(n=np.shape(Y)[0], deg=deg, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                            X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
+                            Log=Log, abs_tol=abs_tol, save_path=save_path, verbose=verbose, cores=cores, cache_dir=cache_dir,
+                            return_log=True)
+
+        message = 'Finished Integration at {}. \nCalculated the PDF for {} and {} for Integrated beta and normal density.\n'.format(datetime.datetime.now(), Y_char, X_char)
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+
+    # The C matrix is never built. Each of its rows is an outer product of the Y and X rows,
+    # so the likelihood is evaluated from these two (n x deg-2) factors.
+    if precision not in ['float64', 'float32']:
+        raise ValueError("precision must be 'float64' or 'float32'")
+    dtype = np.float32 if precision == 'float32' else np.float64
+
+    # Sum of the log row scales, which is a constant term in the log likelihood
+    Y_indv_pdf, Y_log_scale = _rescale_indv_pdf(indv_pdf[0], dtype=dtype)
+    X_indv_pdf, X_log_scale = _rescale_indv_pdf(indv_pdf[1], dtype=dtype)
+    if counts is None:
+        log_scale = np.sum(Y_log_scale) + np.sum(X_log_scale)
+    else:
+        log_scale = np.dot(counts, Y_log_scale + X_log_scale)
 
-    message = 'Finished Integration at {}. \nCalculated the PDF for {} and {} for Integrated beta and normal density.\n'.format(datetime.datetime.now(), Y_char, X_char)
-    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+    if sparse_threshold is not None:
+        Y_indv_pdf, Y_trunc = _sparsify_indv_pdf(Y_indv_pdf, sparse_threshold)
+        X_indv_pdf, X_trunc = _sparsify_indv_pdf(X_indv_pdf, sparse_threshold)
+
+        message = 'Using sparse beta densities with threshold = {}. Kept {:.1f}% of {} and {:.1f}% of {} entries. Maximum truncated fraction per data point = {:.3e}\n'.format(
+                sparse_threshold, 100*Y_indv_pdf.nnz/np.prod(Y_indv_pdf.shape), Y_char,
+                100*X_indv_pdf.nnz/np.prod(X_indv_pdf.shape), X_char, max(np.max(Y_trunc, initial=0), np.max(X_trunc, initial=0)))
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
 
     ###########################################################
     # Run optimization to find the weights
     ###########################################################
 
-    # Ensure that the weights always sum up to 1.
-    def eqn(w):
-        return np.sum(w) - 1
-
     # Function input to optimizer
     def fn1(w):
-        a = - np.sum(np.log(np.matmul(w,C_pdf)))
-        return a
+        return _neg_log_likelihood(w, Y_indv_pdf, X_indv_pdf, counts) - log_scale
 
-    # Define a list of lists of bounds
-    bounds = [[0,1]]*(deg-2)**2
-    # Initial value for weights
-    x0 = np.repeat(1./(deg**2),(deg-2)**2)
+    # Analytic gradient of the objective. Costs about as much as one evaluation of fn1,
+    # instead of (deg-2)**2 evaluations for a finite difference estimate.
+    def fn1_gradient(w):
+        return _neg_log_likelihood_gradient(w, Y_indv_pdf, X_indv_pdf, counts)
 
-    # Run optimization to find optimum value for each degree (weights). These are the coefficients for the beta densities being used as a linear basis.
-    opt_result = fmin_slsqp(fn1, x0, bounds=bounds, f_eqcons=eqn, iter=250, full_output=True, iprint=1,
-                            epsilon=1e-5, acc=1e-5)
-    message = 'Optimization run finished at {}, with {} iterations. Exit Code = {}\n\n'.format(datetime.datetime.now(),
-            opt_result[2], opt_result[3], opt_result[4])
-    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+    if solver not in SOLVERS:
+        raise ValueError('solver must be one of {}'.format(sorted(SOLVERS)))
+
+    trace = []
+
+    def solve(x0, active):
+        # Fit the weights of the active basis functions, keeping the others at zero.
+        fn_active, fn_active_gradient, fn_active_hessp = _active_likelihood(active, Y_indv_pdf, X_indv_pdf, log_scale, counts)
 
+        w_active, n_log_lik, n_iter, exit_code, solver_message, solver_trace = minimize_weights(fn_active,
+                        fn_active_gradient, x0[active], solver=solver, options=solver_options, hessp=fn_active_hessp,
+                        callback=callback, record_trace=record_trace)
+        trace.append(solver_trace)
+
+        w = np.zeros(np.size(x0))
+        w[active] = w_active
+        message = 'Optimization run ({}) finished at {}, with {} iterations. Exit Code = {}. {}\n\n'.format(solver,
+                datetime.datetime.now(), n_iter, exit_code, solver_message)
+        return (w, n_log_lik, n_iter, exit_code), message
+
+    # Initial value for weights
+    if weights_init is not None:
+        x0 = _initial_weights(weights_init, deg)
+    elif solver == 'slsqp':
+        x0 = np.repeat(1./(deg**2),(deg-2)**2)
+    else:
+        # Start at the uniform weights on the simplex
+        x0 = np.repeat(1./((deg-2)**2),(deg-2)**2)
+
+    active = np.ones((deg-2)**2, dtype=bool)
+    if active_set:
+        # Screen for negligible weights with a few EM updates, which are cheap compared to a solver iteration.
+        x0 = _em_weights(x0 / np.sum(x0), Y_indv_pdf, X_indv_pdf, tol=0, max_iter=_ACTIVE_SET_SCREEN_ITER,
+                        counts=counts)[0]
+        active = _prune_weights(x0, -fn1_gradient(x0), active)
+
+    for active_round in range(_ACTIVE_SET_MAX_ROUNDS):
+        opt_result, message = solve(x0, active)
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+        if not active_set:
+            break
+
+        # Check the KKT conditions for the pruned weights. The log likelihood can increase by at most
+        # this duality gap if they are allowed to be non-zero.
+        w = opt_result[0]
+        gradient = -fn1_gradient(w)
+        violated = ~active & (gradient - np.dot(w, gradient) > _ACTIVE_SET_KKT_TOL)
+
+        message = 'Active set round {}: optimized {} of {} weights. {} pruned weights fail the KKT check.\n'.format(
+                    active_round, np.sum(active), np.size(active), np.sum(violated))
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+        if not np.any(violated):
+            break
+
+        # Add the failed weights back with a small starting value (EM updates cannot move a weight away from 0),
+        # and drop the weights which went to zero in this round. A few EM updates then move the new weights
+        # to a reasonable starting point for the solver.
+        active = _prune_weights(w, gradient, active) | violated
+        x0 = np.where(violated, 1e-3/np.size(w), w)
+        x0 = _em_weights(np.where(active, x0, 0) / np.sum(x0[active]), Y_indv_pdf, X_indv_pdf, tol=0,
+                        max_iter=_ACTIVE_SET_SCREEN_ITER, active=active, counts=counts)[0]
 
     unpadded_weight = opt_result[0]
     n_log_lik = opt_result[1]
 
-    # Pad the weight array with zeros for the
-    w_sq = np.reshape(unpadded_weight,[deg-2,deg-2])
-    w_sq_padded = np.zeros((deg,deg))
-    w_sq_padded[1:-1,1:-1] = w_sq
-    w_hat = w_sq_padded.flatten()
+    if record_trace:
+        trace = np.concatenate(trace)
+        trace[:,0] = np.arange(1, len(trace)+1)
+        message = 'Solver trace (iteration, objective, duality gap, wall time):\n' + \
+                    '\n'.join('{:d} {:.10g} {:.4g} {:.4g}'.format(int(t[0]), t[1], t[2], t[3]) for t in trace) + '\n'
+        _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
     if output_weights_only == True:
         return unpadded_weight
 
     else:
-        # Calculate AIC and BIC
-        aic = n_log_lik*2 + 2*(deg**2 - 1)
-        bic = n_log_lik*2 + np.log(n)*(deg**2 - 1)
+        output = _fit_output(unpadded_weight=unpadded_weight, n_log_lik=n_log_lik, n=n, deg=deg,
+                        Y_bounds=Y_bounds, X_bounds=X_bounds, abs_tol=abs_tol, calc_joint_dist=calc_joint_dist,
+                        joint_dist_size=joint_dist_size)
+        if record_trace:
+            output['solver_trace'] = trace
+        return output
 
-        Y_seq = np.linspace(Y_min,Y_max,100)
-        X_seq = np.linspace(X_min,X_max,100)
 
-        output = {'weights': w_hat,
-                  'aic': aic,
-                  'bic': bic,
-                  'Y_points': Y_seq,
-                  'X_points': X_seq}
+def _compress_rows(Y, Y_sigma, X, X_sigma, compress_tol=0., Log=True):
+    '''
+    Find the unique data points, so that each is integrated and evaluated once, with its multiplicity
+    as the weight in the likelihood.
+
+    INPUTS:
+        Y, Y_sigma, X, X_sigma: Numpy arrays of the measurements and uncertainties. NaN uncertainties
+            (no measurement error) are only merged with each other.
+        compress_tol: If 0, merge exact duplicates only. If > 0, bin the measurements and uncertainties
+            with this width (in dex if Log=True, else in linear units), and merge the data points in each bin.
+        Log: If True, bin in log10 of the measurements and uncertainties. Default=True.
+    OUTPUTS:
+        unique_idx: Indices of the data point representing each unique data point (the first in each bin).
+        inverse: Index of the unique data point for each data point.
+        counts: Number of data points merged into each unique data point.
+    '''
+    keys = np.column_stack([Y, Y_sigma, X, X_sigma]).astype(float)
+    no_sigma = np.isnan(keys)
 
+    if compress_tol > 0:
+        if Log:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                keys = np.log10(keys)
+        keys = np.floor(keys / compress_tol)
 
-        deg_vec = np.arange(1,deg+1)
+    # NaN never compares equal, so use a sentinel that no uncertainty (or bin) can take
+    keys[no_sigma] = np.inf
 
-        Y_cond_X_median, Y_cond_X_var, Y_cond_X_quantile = [], [], []
-        X_cond_Y_median, X_cond_Y_var, X_cond_Y_quantile = [], [], []
+    _, unique_idx, inverse, counts = np.unique(keys, axis=0, return_index=True, return_inverse=True, return_counts=True)
 
-        for i in range(0,len(X_seq)):
-            # Conditional Densities with 16% and 84% quantile
-            Y_cond_X = cond_density_quantile(a = X_seq[i], a_max = X_max, a_min = X_min,
-                            b_max = Y_max, b_min = Y_min, deg = deg, deg_vec = deg_vec, w_hat = w_hat, qtl = [0.5,0.16,0.84])[0:3]
-            Y_cond_X_median.append(Y_cond_X[2][0])
-            Y_cond_X_var.append(Y_cond_X[1])
-            Y_cond_X_quantile.append(Y_cond_X[2][1:])
+    return unique_idx, np.ravel(inverse), counts
 
-            X_cond_Y = cond_density_quantile(a = Y_seq[i], a_max=Y_max, a_min=Y_min,
-                                b_max=X_max, b_min=X_min, deg=deg, deg_vec = deg_vec,
-                                w_hat=np.reshape(w_hat,(deg,deg)).T.flatten(), qtl = [0.5,0.16,0.84])[0:3]
-            X_cond_Y_median.append(X_cond_Y[2][0])
-            X_cond_Y_var.append(X_cond_Y[1])
-            X_cond_Y_quantile.append(X_cond_Y[2][1:])
 
+def _minibatch_fit(deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, abs_tol, Log, save_path, verbose,
+                indv_pdf=None, cores=1, cache_dir=None, minibatch_size=1000, minibatch_options=None, counts=None):
+    '''
+    Fit the weights with stepwise EM on chunks of the data points, for MLE_fit(minibatch_size=...).
+    The data points are shuffled once, and the chunks are contiguous slices of the shuffled order.
+    If indv_pdf is None, the log integrated beta densities for each chunk are computed the first time the
+    chunk is used and stored in a memory mapped file, which is deleted at the end.
+    counts is the multiplicity of each data point in the likelihood (see _compress_rows()), or None.
 
+    OUTPUTS:
+        unpadded_weight: Fitted weights ((deg-2)**2).
+        n_log_lik: Negative log likelihood of all the data points, accumulated one chunk at a time.
+    '''
+    n = np.shape(Y)[0]
+    n_basis = deg - 2
+    deg_vec = np.arange(2, deg)
+    order = np.random.permutation(n)
+    if minibatch_options is None:
+        minibatch_options = {}
+    if counts is not None:
+        counts = np.asarray(counts, dtype=float)[order]
+
+    store_dir = None
+    if indv_pdf is not None:
+        def read_chunk(start, stop):
+            return indv_pdf[0][order[start:stop]], indv_pdf[1][order[start:stop]]
+    else:
+        store_dir = tempfile.mkdtemp(dir=save_path)
+        Y_store = np.lib.format.open_memmap(os.path.join(store_dir, 'Y_indv_pdf.npy'), mode='w+', shape=(n, n_basis))
+        X_store = np.lib.format.open_memmap(os.path.join(store_dir, 'X_indv_pdf.npy'), mode='w+', shape=(n, n_basis))
+        integrated = np.zeros(n, dtype=bool)
+
+        def read_chunk(start, stop):
+            if not np.all(integrated[start:stop]):
+                idx = order[start:stop]
+                Y_store[start:stop] = _find_indv_pdf_batch(Y[idx], deg, deg_vec, Y_max, Y_min, Y_sigma[idx],
+                                            abs_tol=abs_tol, Log=Log, cores=cores, cache_dir=cache_dir, return_log=True)[0]
+                X_store[start:stop] = _find_indv_pdf_batch(X[idx], deg, deg_vec, X_max, X_min, X_sigma[idx],
+                                            abs_tol=abs_tol, Log=Log, cores=cores, cache_dir=cache_dir, return_log=True)[0]
+                integrated[start:stop] = True
+            return np.array(Y_store[start:stop]), np.array(X_store[start:stop])
+
+    try:
+        w0 = np.repeat(1./(n_basis**2), n_basis**2)
+        unpadded_weight, n_epochs, converged, holdout_log_lik = _minibatch_em_weights(w0, read_chunk, n,
+                                                                    minibatch_size, counts=counts, **minibatch_options)
+
+        n_log_lik = 0.
+        for start in range(0, n, minibatch_size):
+            stop = min(start + minibatch_size, n)
+            n_log_lik += _neg_log_likelihood_log(unpadded_weight, *read_chunk(start, stop),
+                                        counts=None if counts is None else counts[start:stop])
+    finally:
+        if store_dir is not None:
+            del Y_store, X_store
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    message = 'Stepwise EM with chunks of {} finished at {}, after {} epochs. Converged = {}. Held out log likelihood per data point for each epoch: {}\n\n'.format(
+                minibatch_size, datetime.datetime.now(), n_epochs, converged, np.array2string(holdout_log_lik, precision=6))
+    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
-        # Output everything as dictionary
+    return unpadded_weight, n_log_lik
 
-        output['Y_cond_X'] = Y_cond_X_median
-        output['Y_cond_X_var'] = Y_cond_X_var
-        output['Y_cond_X_quantile'] = np.array(Y_cond_X_quantile)
-        output['X_cond_Y'] = X_cond_Y_median
-        output['X_cond_Y_var'] = X_cond_Y_var
-        output['X_cond_Y_quantile'] = np.array(X_cond_Y_quantile)
 
-        if calc_joint_dist == True:
-            joint_dist = calculate_joint_distribution(X_seq, X_min, X_max, Y_seq, Y_min, Y_max, w_hat, abs_tol)
-            output['joint_dist'] = joint_dist
+def _minibatch_em_weights(w0, read_chunk, n, chunk_size, holdout_size=None, tol=1e-6, max_epochs=100,
+                        step_exponent=0.6, counts=None):
+    '''
+    Stepwise (online) EM for the weights. For each chunk of m data points, the EM update of the
+    weights using only that chunk is w * g / m, where g is the gradient of the chunk log likelihood.
+    Instead of replacing the weights, it is averaged in with a decreasing step size
+        w <- (1 - eta_k) * w + eta_k * (w * g / m),    eta_k = (1 + k/n_chunks)**-step_exponent
+    for the k-th chunk (counted over all epochs), with n_chunks chunks in each epoch. This stays on the
+    simplex and converges to the maximum likelihood weights for 0.5 < step_exponent <= 1. The step size
+    decays after every chunk, but on the time scale of an epoch (it halves after about 2**(1/step_exponent) - 1
+    epochs), which keeps the updates in the first epoch close to EM on each chunk.
+    With counts, m is the total multiplicity of the data points in the chunk.
+    Only one chunk is in memory at a time.
+
+    The last holdout_size data points are never used for the updates. After each pass over the other
+    chunks (an epoch), the mean log likelihood of the held out points is the convergence check.
+
+    Refer to Cappe & Moulines 2009, and Liang & Klein 2009 (stepwise EM).
+
+    INPUTS:
+        w0: Initial weights.
+        read_chunk: Function read_chunk(start, stop) returning the log integrated beta densities
+            (Y_indv_pdf, X_indv_pdf) for data points start to stop.
+        n: Number of data points.
+        chunk_size: Number of data points in each chunk.
+        holdout_size: Number of held out data points. Default=None, to use chunk_size.
+        tol: Stop when the mean held out log likelihood changes by less than tol over an epoch. Default=1e-6.
+        max_epochs: Maximum number of passes over the data. Default=100.
+        step_exponent: Exponent for the step size. Default=0.6.
+        counts: Multiplicity of each data point in the likelihood, or None. Default=None.
+    OUTPUTS:
+        w: Fitted weights.
+        n_epochs: Number of epochs.
+        converged: True if the held out log likelihood converged within max_epochs.
+        holdout_log_lik: Numpy array with the mean held out log likelihood after each epoch.
+    '''
+    if holdout_size is None:
+        holdout_size = chunk_size
+    n_train = n - holdout_size
+    if n_train < 1 or holdout_size < 1:
+        raise ValueError('holdout_size must be between 1 and the number of data points - 1')
+
+    if counts is None:
+        counts = np.ones(n)
+    Y_holdout, X_holdout = read_chunk(n_train, n)
+    holdout_counts = counts[n_train:]
+    starts = np.arange(0, n_train, chunk_size)
+
+    w = np.asarray(w0, dtype=float)
+    w = w / np.sum(w)
+    previous = -_neg_log_likelihood_log(w, Y_holdout, X_holdout, holdout_counts)/np.sum(holdout_counts)
+    holdout_log_lik = []
+    converged = False
+    k = 0
+
+    for epoch in range(max_epochs):
+        for start in np.random.permutation(starts):
+            stop = min(start + chunk_size, n_train)
+            Y_log_indv_pdf, X_log_indv_pdf = read_chunk(start, stop)
+            # The row scales do not change the EM update, so only the rescaled rows are needed.
+            Y_indv_pdf = _rescale_indv_pdf(Y_log_indv_pdf)[0]
+            X_indv_pdf = _rescale_indv_pdf(X_log_indv_pdf)[0]
+
+            g = -_neg_log_likelihood_gradient(w, Y_indv_pdf, X_indv_pdf, counts[start:stop])
+            step = (1. + k/len(starts))**(-step_exponent)
+            w = (1 - step)*w + step*w*g/np.sum(counts[start:stop])
+            w = w / np.sum(w)
+            k += 1
+
+        current = -_neg_log_likelihood_log(w, Y_holdout, X_holdout, holdout_counts)/np.sum(holdout_counts)
+        holdout_log_lik.append(current)
+        if abs(current - previous) <= tol:
+            converged = True
+            break
+        previous = current
+
+    return w, epoch + 1, converged, np.array(holdout_log_lik)
+
+
+def _fit_output(unpadded_weight, n_log_lik, n, deg, Y_bounds, X_bounds, abs_tol=1e-8, calc_joint_dist=False,
+                joint_dist_size=100):
+    '''
+    Build the output dictionary of MLE_fit() from the fitted weights.
+
+    INPUTS:
+        unpadded_weight: Fitted weights ((deg-2)**2).
+        n_log_lik: Negative log likelihood at the fitted weights.
+        n: Number of data points, used for the BIC.
+        deg: Degree used for beta densities.
+        Y_bounds, X_bounds: Bounds for Y and X.
+        abs_tol: Absolute tolerance, passed to calculate_joint_distribution().
+        calc_joint_dist: If True, calculate the joint distribution.
+        joint_dist_size: Number of grid points along each axis for the joint distribution,
+            or a tuple of (number of X points, number of Y points). Default=100.
+    OUTPUT:
+        output: Output dictionary. See MLE_fit().
+    '''
+    Y_max = Y_bounds[1]
+    Y_min = Y_bounds[0]
+    X_max = X_bounds[1]
+    X_min = X_bounds[0]
+
+    # Pad the weight array with zeros for the
+    w_sq = np.reshape(unpadded_weight,[deg-2,deg-2])
+    w_sq_padded = np.zeros((deg,deg))
+    w_sq_padded[1:-1,1:-1] = w_sq
+    w_hat = w_sq_padded.flatten()
+
+    # Calculate AIC and BIC
+    aic = n_log_lik*2 + 2*(deg**2 - 1)
+    bic = n_log_lik*2 + np.log(n)*(deg**2 - 1)
+
+    Y_seq = np.linspace(Y_min,Y_max,100)
+    X_seq = np.linspace(X_min,X_max,100)
+
+    output = {'weights': w_hat,
+              'aic': aic,
+              'bic': bic,
+              'Y_points': Y_seq,
+              'X_points': X_seq}
 
-        return output
 
+    deg_vec = np.arange(1,deg+1)
+
+    # Conditional Densities with 16% and 84% quantile, for all the X_seq (and Y_seq) points at once
+    _, Y_cond_X_var, Y_cond_X_quantile = cond_density_quantile_batch(a = X_seq, a_max = X_max, a_min = X_min,
+                        b_max = Y_max, b_min = Y_min, deg = deg, deg_vec = deg_vec, w_hat = w_hat, qtl = [0.5,0.16,0.84])[0:3]
+
+    _, X_cond_Y_var, X_cond_Y_quantile = cond_density_quantile_batch(a = Y_seq, a_max=Y_max, a_min=Y_min,
+                        b_max=X_max, b_min=X_min, deg=deg, deg_vec = deg_vec,
+                        w_hat=np.reshape(w_hat,(deg,deg)).T.flatten(), qtl = [0.5,0.16,0.84])[0:3]
+
+    # Output everything as dictionary
+
+    output['Y_cond_X'] = Y_cond_X_quantile[:,0]
+    output['Y_cond_X_var'] = Y_cond_X_var
+    output['Y_cond_X_quantile'] = Y_cond_X_quantile[:,1:]
+    output['X_cond_Y'] = X_cond_Y_quantile[:,0]
+    output['X_cond_Y_var'] = X_cond_Y_var
+    output['X_cond_Y_quantile'] = X_cond_Y_quantile[:,1:]
 
-def calc_C_matrix(n, deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, abs_tol, save_path, Log, verbose):
+    if calc_joint_dist == True:
+        X_size, Y_size = np.broadcast_to(joint_dist_size, 2).astype(int)
+        joint_dist = calculate_joint_distribution(np.linspace(X_min,X_max,X_size), X_min, X_max,
+                                            np.linspace(Y_min,Y_max,Y_size), Y_min, Y_max, w_hat, abs_tol)
+        output['joint_dist'] = joint_dist
+
+    return output
+
+
+def calc_C_matrix(n, deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, abs_tol, save_path, Log, verbose,
+                    method='vectorized'):
     '''
     Integrate the product of the normal and beta distributions for Y and X and then take the Kronecker product.
 
     Refer to Ning et al. 2018 Sec 2.2 Eq 8 and 9.
 
+    \nINPUTS:
+        Same as calc_indv_pdf().
+
+    OUTPUTS:
+
+        C_pdf : Matrix explained in Ning et al. Equation 8. Product of (integrals of (product of normal and beta
+                distributions)) for  Y and x.
+    '''
+    Y_indv_pdf, X_indv_pdf = calc_indv_pdf(n=n, deg=deg, Y=Y, Y_sigma=Y_sigma, Y_max=Y_max, Y_min=Y_min,
+                                X=X, X_sigma=X_sigma, X_max=X_max, X_min=X_min,
+                                abs_tol=abs_tol, save_path=save_path, Log=Log, verbose=verbose, method=method)
+
+    return _assemble_C_matrix(Y_indv_pdf, X_indv_pdf)
+
+
+def calc_indv_pdf(n, deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, abs_tol, save_path, Log, verbose,
+                    method='vectorized', cores=1, cache_dir=None, return_log=False):
+    '''
+    Integrate the product of the normal and beta distributions for Y and X, for each data point.
+    The C matrix is the row-wise Kronecker product of the two outputs (see _assemble_C_matrix()).
+
+    Refer to Ning et al. 2018 Sec 2.2 Eq 8.
+
     \nINPUTS:
         n: Number of data points
         deg: Degree used for beta densities
@@ -231,32 +640,164 @@ def calc_C_matrix(n, deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, ab
             If 0: Will not log in the log file or print statements.
             If 1: Will write log file only.
             If 2: Will write log file and print statements.
+        method: Integration backend.
+            If 'vectorized': Integrate all the data points and degrees together
+                using composite Gauss-Legendre quadrature (_find_indv_pdf_batch()). Default.
+            If 'quad': Integrate each data point and degree separately using scipy.integrate.quad.
+        cores: Number of cores for parallel processing. If > 1, the data points are split into
+            chunks which are integrated in a process pool. Only used if method='vectorized'. Default=1.
+        cache_dir: Directory for a persistent on-disk cache of the integrated rows, keyed by the measurement,
+            uncertainty, bounds, degree, Log and abs_tol. Only the data points not in the cache are integrated.
+            The rows integrated together are stored as one batch file, and the least recently used batches
+            are evicted when the cache grows beyond utils._BASIS_CACHE_MAX_BYTES.
+            Only used if method='vectorized'. Default=None (no cache).
+        return_log: If True, return the log of the integrated beta densities. These do not underflow
+            for data points far from the peak of a beta density, and are the input MLE_fit() expects
+            for indv_pdf. Default=False.
 
     OUTPUTS:
 
-        C_pdf : Matrix explained in Ning et al. Equation 8. Product of (integrals of (product of normal and beta
-                distributions)) for  Y and x.
+        Y_indv_pdf : Numpy array of shape (n, deg-2) with the integrated beta densities for Y.
+        X_indv_pdf : Numpy array of shape (n, deg-2) with the integrated beta densities for X.
     '''
     deg_vec = np.arange(2,deg)
 
-    Y_indv_pdf = np.zeros((n, deg-2))
-    X_indv_pdf = np.zeros((n, deg-2))
-    C_pdf = np.zeros((n, (deg-2)**2))
+    message = 'Started Integration at {}\n'.format(datetime.datetime.now())
+    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
+
+    if method == 'quad':
+        Y_indv_pdf = np.zeros((n, deg-2))
+        X_indv_pdf = np.zeros((n, deg-2))
 
+        # Loop across each data point.
+        for i in range(0,n):
+            Y_indv_pdf[i,:] = _find_indv_pdf(Y[i], deg, deg_vec, Y_max, Y_min, Y_sigma[i], abs_tol=abs_tol, Log=Log)
+            X_indv_pdf[i,:] = _find_indv_pdf(X[i], deg, deg_vec, X_max, X_min, X_sigma[i], abs_tol=abs_tol, Log=Log)
 
-    message = 'Started Integration at {}\n'.format(datetime.datetime.now())
+        if return_log:
+            with np.errstate(divide='ignore'):
+                Y_indv_pdf, X_indv_pdf = np.log(Y_indv_pdf), np.log(X_indv_pdf)
+
+    elif method == 'vectorized':
+        Y_indv_pdf, Y_err = _find_indv_pdf_batch(Y, deg, deg_vec, Y_max, Y_min, Y_sigma, abs_tol=abs_tol, Log=Log,
+                                    cores=cores, cache_dir=cache_dir, return_log=return_log)
+        X_indv_pdf, X_err = _find_indv_pdf_batch(X, deg, deg_vec, X_max, X_min, X_sigma, abs_tol=abs_tol, Log=Log,
+                                    cores=cores, cache_dir=cache_dir, return_log=return_log)
+
+        _log_integration_error(Y_err, X_err, abs_tol=abs_tol, save_path=save_path, verbose=verbose)
+
+    else:
+        raise ValueError("method must be 'vectorized' or 'quad'")
+
+    return Y_indv_pdf, X_indv_pdf
+
+
+def calc_indv_pdf_degrees(n, degrees, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, abs_tol, save_path, Log, verbose,
+                            cores=1, cache_dir=None, return_log=False):
+    '''
+    Integrate the product of the normal and beta distributions for Y and X, for several degrees at once.
+
+    The basis is integrated only once, for all the components of the largest degree. Beta densities of lower
+    degrees are exact positive combinations of those of the next degree (Bernstein degree elevation),
+    so the integrated rows for every other degree are derived from it without further integration.
+    See _reduce_degree().
+
+    \nINPUTS:
+        degrees: List or array of degrees, for eg. the degree candidates for cross validation/AIC/BIC.
+        Rest are the same as calc_indv_pdf() (with method='vectorized').
+
+    OUTPUTS:
+
+        indv_pdf: Dictionary keyed by degree, with values (Y_indv_pdf, X_indv_pdf) identical in
+            form to the output of calc_indv_pdf() for that degree (log values if return_log=True).
+    '''
+    degrees = set(int(d) for d in np.atleast_1d(degrees))
+    deg_max = max(degrees)
+    deg_vec = np.arange(1, deg_max+1)
+
+    message = 'Started Integration for degrees {} at {}\n'.format(sorted(degrees), datetime.datetime.now())
     _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
+    Y_full, Y_err = _find_indv_pdf_batch(Y, deg_max, deg_vec, Y_max, Y_min, Y_sigma, abs_tol=abs_tol, Log=Log,
+                                cores=cores, cache_dir=cache_dir, return_log=True)
+    X_full, X_err = _find_indv_pdf_batch(X, deg_max, deg_vec, X_max, X_min, X_sigma, abs_tol=abs_tol, Log=Log,
+                                cores=cores, cache_dir=cache_dir, return_log=True)
+    _log_integration_error(Y_err, X_err, abs_tol=abs_tol, save_path=save_path, verbose=verbose)
+
+    indv_pdf = {}
+    for deg in range(deg_max, min(degrees)-1, -1):
+        if deg in degrees:
+            if cache_dir is not None:
+                # Cache the derived rows under the same keys as calc_indv_pdf() at this degree,
+                # so that a later fit at the chosen degree does not integrate again.
+                _cache_derived_rows(cache_dir, Y, Y_sigma, deg, Y_max, Y_min, abs_tol, Log, Y_full[:,1:-1], Y_err)
+                _cache_derived_rows(cache_dir, X, X_sigma, deg, X_max, X_min, abs_tol, Log, X_full[:,1:-1], X_err)
+            # Drop the first and last beta densities, as in calc_indv_pdf()
+            if return_log:
+                indv_pdf[deg] = (Y_full[:,1:-1].copy(), X_full[:,1:-1].copy())
+            else:
+                indv_pdf[deg] = (np.exp(Y_full[:,1:-1]), np.exp(X_full[:,1:-1]))
+        Y_full = _reduce_degree(Y_full, log=True)
+        X_full = _reduce_degree(X_full, log=True)
+
+    return indv_pdf
+
+
+def _cache_derived_rows(cache_dir, a, a_std, deg, a_max, a_min, abs_tol, Log, log_indv, error):
+    '''
+    Add the log integrated beta densities for degree deg, derived in calc_indv_pdf_degrees(), to the on-disk
+    cache in the same form as _find_indv_pdf_batch() stores them. Since the error does not grow when reducing
+    the degree (see _reduce_degree()), the error estimate of the integration at the largest degree is kept.
+    Data points already in the cache are skipped.
+    '''
+    a_std = np.full(np.shape(a), np.nan) if a_std is None else np.asarray(a_std, dtype=float)
+    keys = _basis_cache_keys(a, a_std, deg=deg, deg_vec=np.arange(2, deg), a_max=a_max, a_min=a_min,
+                            abs_tol=abs_tol, Log=Log)
+    cached = _cache_locations(cache_dir)
+
+    new = {}
+    for i, key in enumerate(keys):
+        if key not in cached and key not in new:
+            new[key] = i
+    if new:
+        idx = np.array(list(new.values()))
+        _save_cached_rows(cache_dir, list(new.keys()), np.column_stack([log_indv[idx], error[idx]]))
+
+
+def _reduce_degree(a_indv_pdf, log=False):
+    '''
+    Given beta densities (or their integrals) for all the components d = 1..deg+1 of degree deg+1,
+    find those for degree deg using
+
+        beta(d, deg-d+1) = [(deg-d+1)*beta(d, deg-d+2) + d*beta(d+1, deg-d+1)] / (deg+1)
 
+    Since the coefficients are positive and sum to one, the integration error does not grow.
+    If log=True, a_indv_pdf and the output are log values.
+    '''
+    deg = np.shape(a_indv_pdf)[1] - 1
+    d = np.arange(1, deg+1)
+    if log:
+        return np.logaddexp(np.log((deg - d + 1)/(deg + 1)) + a_indv_pdf[:,:-1], np.log(d/(deg + 1)) + a_indv_pdf[:,1:])
+    return ((deg - d + 1) * a_indv_pdf[:,:-1] + d * a_indv_pdf[:,1:])/(deg + 1)
+
+
+def _log_integration_error(Y_err, X_err, abs_tol, save_path, verbose):
+    '''
+    Log the maximum estimated integration error from _find_indv_pdf_batch(), compared against abs_tol.
+    '''
+    max_err = max(np.max(Y_err, initial=0), np.max(X_err, initial=0))
+    n_fail = np.sum(Y_err > abs_tol) + np.sum(X_err > abs_tol)
+    message = 'Maximum estimated integration error = {:.3e} (abs_tol = {}). {} integrals did not reach abs_tol.\n'.format(max_err, abs_tol, n_fail)
+    _ = _logging(message=message, filepath=save_path, verbose=verbose, append=True)
 
-    # Loop across each data point.
-    for i in range(0,n):
-        Y_indv_pdf[i,:] = _find_indv_pdf(Y[i], deg, deg_vec, Y_max, Y_min, Y_sigma[i], abs_tol=abs_tol, Log=Log)
-        X_indv_pdf[i,:] = _find_indv_pdf(X[i], deg, deg_vec, X_max, X_min, X_sigma[i], abs_tol=abs_tol, Log=Log)
-        # print(M[i],Y_sigma[i], R[i], X_sigma[i], Y_max, Y_min, X_max, X_min, np.sum(R_indv_pdf[i,:]))
 
-        # Put M.indv.pdf and R.indv.pdf into a big matrix
-        C_pdf[i,:] = np.kron(Y_indv_pdf[i], X_indv_pdf[i])
+def _assemble_C_matrix(Y_indv_pdf, X_indv_pdf):
+    '''
+    Build the C matrix from the integrated beta densities for Y and X.
+    Column i of C_pdf is np.kron(Y_indv_pdf[i], X_indv_pdf[i]).
+    '''
+    n = np.shape(Y_indv_pdf)[0]
+    C_pdf = (Y_indv_pdf[:,:,None] * X_indv_pdf[:,None,:]).reshape(n, -1)
 
     C_pdf = C_pdf.T
 
@@ -266,6 +807,430 @@ def calc_C_matrix(n, deg, Y, Y_sigma, Y_max, Y_min, X, X_sigma, X_max, X_min, ab
     return C_pdf
 
 
+def _likelihood_per_point(w, Y_indv_pdf, X_indv_pdf):
+    '''
+    Likelihood of each data point, i.e. np.matmul(w, C_pdf) without building the C matrix.
+    Since column i of C_pdf is np.kron(Y_indv_pdf[i], X_indv_pdf[i]), this is
+    Y_indv_pdf[i] . W . X_indv_pdf[i] with W = w reshaped to a square matrix.
+    Memory used grows as n*deg instead of n*deg**2.
+    '''
+    deg = np.shape(Y_indv_pdf)[1]
+    # Match the precision of the beta densities, so that float32 rows are not upcast
+    W = np.reshape(w, (deg, deg)).astype(Y_indv_pdf.dtype, copy=False)
+    YW = Y_indv_pdf.dot(W)
+
+    if scipy.sparse.issparse(X_indv_pdf):
+        return np.asarray(X_indv_pdf.multiply(YW).sum(axis=1)).ravel()
+    return np.sum(YW * X_indv_pdf, axis=1)
+
+
+def _neg_log_likelihood(w, Y_indv_pdf, X_indv_pdf, counts=None):
+    '''
+    Negative log likelihood of the weights, from the factored C matrix.
+    If counts is given, each data point is weighted by its multiplicity (see _compress_rows()).
+    Refer to Ning et al. 2018 Sec 2.2, Eq 9.
+    '''
+    # Log of 0 throws weird errors
+    likelihood = _likelihood_per_point(w, Y_indv_pdf, X_indv_pdf)
+    likelihood = np.maximum(likelihood, _likelihood_floor(likelihood.dtype))
+    if counts is not None:
+        return - np.dot(counts, np.log(likelihood, dtype=np.float64))
+    return - np.sum(np.log(likelihood), dtype=np.float64)
+
+
+def _neg_log_likelihood_gradient(w, Y_indv_pdf, X_indv_pdf, counts=None):
+    '''
+    Gradient of _neg_log_likelihood() with respect to the weights, from the factored C matrix.
+    d/dW of -sum(log(y_i . W . x_i)) = -sum(outer(y_i, x_i) / (y_i . W . x_i))
+    '''
+    likelihood = _likelihood_per_point(w, Y_indv_pdf, X_indv_pdf)
+    likelihood = np.maximum(likelihood, _likelihood_floor(likelihood.dtype))
+    if counts is not None:
+        likelihood = likelihood / counts
+
+    if scipy.sparse.issparse(Y_indv_pdf):
+        Y_scaled = scipy.sparse.csr_matrix(Y_indv_pdf.multiply(1/likelihood[:,None]))
+    else:
+        Y_scaled = Y_indv_pdf / likelihood[:,None]
+
+    gradient = Y_scaled.T.dot(X_indv_pdf)
+    if scipy.sparse.issparse(gradient):
+        gradient = gradient.toarray()
+    return - np.asarray(gradient, dtype=np.float64).flatten()
+
+
+def _initial_weights(weights_init, deg, floor=1e-4):
+    '''
+    Convert weights from an earlier fit into a starting point for the optimizer.
+    The weights are unpadded if needed, normalized to sum to 1, and mixed with a small fraction (floor)
+    of uniform weights. EM updates cannot move a weight away from exactly zero, so this keeps every
+    basis function available to the optimizer.
+
+    INPUTS:
+        weights_init: Padded (deg**2) or unpadded ((deg-2)**2) weights.
+        deg: Degree used for beta densities.
+        floor: Fraction of uniform weights mixed in. Default=1e-4.
+    OUTPUT:
+        x0: Unpadded initial weights ((deg-2)**2), summing to 1.
+    '''
+    weights_init = np.asarray(weights_init, dtype=float).flatten()
+    if np.size(weights_init) == deg**2:
+        weights_init = np.reshape(weights_init, (deg,deg))[1:-1,1:-1].flatten()
+    elif np.size(weights_init) != (deg-2)**2:
+        raise ValueError('weights_init has {} elements, expected {} or {} for degree {}'.format(
+                        np.size(weights_init), deg**2, (deg-2)**2, deg))
+
+    x0 = np.clip(weights_init, 0, None)
+    if not np.sum(x0) > 0:
+        return np.repeat(1./((deg-2)**2),(deg-2)**2)
+    x0 = x0 / np.sum(x0)
+    return (1 - floor)*x0 + floor/np.size(x0)
+
+
+def _resample_weights(weights, deg, deg_new):
+    '''
+    Resample weights fitted with one degree onto the basis of another degree, to seed the fit at deg_new.
+    The joint density sum(w_jk * beta_j(y) * beta_k(x)) is binned onto a deg_new x deg_new grid on the unit square,
+    and the probability in each cell is used as the weight of the corresponding beta densities at deg_new.
+
+    INPUTS:
+        weights: Padded (deg**2) or unpadded ((deg-2)**2) weights fitted at degree deg.
+        deg: Degree of weights.
+        deg_new: Degree to resample onto.
+    OUTPUT:
+        weights_new: Unpadded weights ((deg_new-2)**2) for degree deg_new, summing to 1.
+    '''
+    weights = np.asarray(weights, dtype=float).flatten()
+    if np.size(weights) == (deg-2)**2:
+        w_sq = np.zeros((deg,deg))
+        w_sq[1:-1,1:-1] = np.reshape(weights, (deg-2,deg-2))
+    else:
+        w_sq = np.reshape(weights, (deg,deg))
+
+    # Probability of each beta density (deg) in each of the deg_new cells.
+    edges = np.linspace(0, 1, deg_new+1)
+    cell_probability = np.diff(beta_cdf_matrix(edges, deg=deg).T, axis=1)
+
+    w_new = np.dot(np.dot(cell_probability.T, w_sq), cell_probability)[1:-1,1:-1]
+    return _initial_weights(w_new, deg_new, floor=0)
+
+
+def _seed_weights(weights_per_degree, deg):
+    '''
+    Initial weights for a fit at degree deg, from a dictionary of weights already fitted at other degrees.
+    Uses the weights at deg if present, otherwise resamples those of the nearest degree with _resample_weights().
+
+    INPUTS:
+        weights_per_degree: Dictionary with degrees as keys and padded or unpadded weights as values.
+        deg: Degree of the new fit.
+    OUTPUT:
+        weights_init: Weights to pass to MLE_fit(), or None if weights_per_degree is empty.
+    '''
+    if not weights_per_degree:
+        return None
+    if deg in weights_per_degree:
+        return weights_per_degree[deg]
+    nearest = min(weights_per_degree, key=lambda d: abs(d - deg))
+    return _resample_weights(weights_per_degree[nearest], deg=nearest, deg_new=deg)
+
+
+def _prune_weights(w, gradient, active, prune_tol=1e-8):
+    '''
+    Drop the basis functions from the active set whose weight is negligible, and whose gradient shows
+    that increasing the weight would decrease the likelihood, i.e. it is below the Lagrange multiplier
+    of the sum to one constraint (w . gradient).
+
+    INPUTS:
+        w: Weights ((deg-2)**2).
+        gradient: Gradient of the log likelihood at w.
+        active: Boolean numpy array, True for the weights being optimized.
+        prune_tol: Weights below prune_tol are considered negligible. Default=1e-8.
+    OUTPUT:
+        active: Updated boolean numpy array.
+    '''
+    return active & ~((w < prune_tol) & (gradient < np.dot(w, gradient)))
+
+
+def _em_weights(w0, Y_indv_pdf, X_indv_pdf, tol=1e-6, max_iter=10000, acceleration='squarem', active=None,
+                counts=None):
+    '''
+    Find the weights which maximize the likelihood using expectation maximization.
+    Since the weights are mixture proportions, the fixed point update is
+        w <- w * (C . (1/(w . C))) / n
+    which is the weights times the negative gradient of the negative log likelihood, divided by n.
+    See solvers._solve_em().
+
+    INPUTS:
+        w0: Initial weights. Numpy array of (deg-2)**2 non-negative values summing to 1.
+        Y_indv_pdf, X_indv_pdf: Integrated beta densities for each data point (n x deg-2).
+        tol: Stop when the duality gap is smaller than tol. Default=1e-6.
+        max_iter: Maximum number of iterations. Each SQUAREM iteration uses three EM updates.
+        acceleration: 'squarem' or None.
+        active: Boolean numpy array, True for the weights being optimized. The others are kept at zero.
+            Default=None, for all the weights.
+        counts: Multiplicity of each data point. Default=None, for one each.
+    OUTPUTS:
+        w: Weights.
+        n_log_lik: Negative log likelihood at w.
+        n_iter: Number of iterations.
+        converged: True if the tolerance was reached before max_iter.
+    '''
+    w0 = np.asarray(w0, dtype=float)
+    if active is None:
+        active = np.ones(np.size(w0), dtype=bool)
+
+    objective, gradient, _ = _active_likelihood(active, Y_indv_pdf, X_indv_pdf, counts=counts)
+    w_active, n_log_lik, n_iter, exit_code, _ = _solve_em(objective, gradient, w0[active], tol=tol,
+                                                max_iter=max_iter, acceleration=acceleration)
+
+    w = np.zeros(np.size(w0))
+    w[active] = w_active
+    return w, n_log_lik, n_iter, exit_code == 0
+
+
+def _active_likelihood(active, Y_indv_pdf, X_indv_pdf, log_scale=0., counts=None):
+    '''
+    Negative log likelihood, its gradient and Hessian vector product as functions of the active weights only.
+    The other weights are fixed at zero.
+
+    INPUTS:
+        active: Boolean numpy array, True for the weights being optimized.
+        Y_indv_pdf, X_indv_pdf: Integrated beta densities for each data point (n x deg-2).
+        log_scale: Constant subtracted from the negative log likelihood. See _rescale_indv_pdf().
+        counts: Multiplicity of each data point. Default=None, for one each.
+    OUTPUTS:
+        objective, gradient, hessp: Functions of the active weights (and a vector, for hessp).
+    '''
+    n_weights = np.size(active)
+
+    def full_weights(w_active):
+        w = np.zeros(n_weights)
+        w[active] = w_active
+        return w
+
+    def objective(w_active):
+        return _neg_log_likelihood(full_weights(w_active), Y_indv_pdf, X_indv_pdf, counts) - log_scale
+
+    def gradient(w_active):
+        return _neg_log_likelihood_gradient(full_weights(w_active), Y_indv_pdf, X_indv_pdf, counts)[active]
+
+    def hessp(w_active, v_active):
+        return _neg_log_likelihood_hessp(full_weights(w_active), full_weights(v_active), Y_indv_pdf, X_indv_pdf,
+                                        counts)[active]
+
+    return objective, gradient, hessp
+
+
+def _em_weights_batch(w0, Y_indv_pdf, X_indv_pdf, counts, tol=1e-6, max_iter=10000, acceleration='squarem',
+                    max_elements=2**24):
+    '''
+    Fit the weights for many resamples of the same data points at once, using the EM updates of _em_weights().
+    A bootstrap resample is the original data with integer multiplicities, so every resample shares the same
+    integrated beta densities and only the counts of each data point differ. The log likelihood of resample b is
+        sum_i counts[b,i] * log(y_i . W_b . x_i)
+    All the weights are stored as a (num_boot x (deg-2)**2) array and updated with batched matrix products.
+    Resamples which have converged are dropped from the updates.
+
+    INPUTS:
+        w0: Initial weights. Numpy array of (deg-2)**2 values (used for every resample),
+            or of shape (num_boot, (deg-2)**2). Non-negative and summing to 1.
+        Y_indv_pdf, X_indv_pdf: Integrated beta densities for each data point (n x deg-2). Dense arrays.
+        counts: Numpy array (num_boot x n) of the number of times each data point is in each resample.
+        tol: Stop when the duality gap is smaller than tol. See _em_weights(). Default=1e-6.
+        max_iter: Maximum number of iterations. Default=10000.
+        acceleration: 'squarem' or None. Default='squarem'.
+        max_elements: Maximum size of the temporary (resamples x n x deg-2) arrays. The resamples
+            are processed in groups to stay below this. Default=2**24.
+    OUTPUTS:
+        w: Numpy array (num_boot x (deg-2)**2) of weights.
+        n_log_lik: Numpy array (num_boot) of the negative log likelihood for each resample.
+        n_iter: Numpy array (num_boot) of the number of iterations for each resample.
+        converged: Boolean numpy array (num_boot), True if the tolerance was reached before max_iter.
+    '''
+    if scipy.sparse.issparse(Y_indv_pdf):
+        Y_indv_pdf = Y_indv_pdf.toarray()
+    if scipy.sparse.issparse(X_indv_pdf):
+        X_indv_pdf = X_indv_pdf.toarray()
+    Y_indv_pdf = np.asarray(Y_indv_pdf, dtype=float)
+    X_indv_pdf = np.asarray(X_indv_pdf, dtype=float)
+
+    counts = np.atleast_2d(np.asarray(counts, dtype=float))
+    num_boot, n = np.shape(counts)
+    k = np.shape(Y_indv_pdf)[1]
+    w = np.array(np.broadcast_to(w0, (num_boot, k*k)), dtype=float)
+
+    n_log_lik = np.zeros(num_boot)
+    n_iter = np.zeros(num_boot, dtype=int)
+    converged = np.zeros(num_boot, dtype=bool)
+
+    group_size = max(1, int(max_elements // (n*k)))
+    for start in range(0, num_boot, group_size):
+        group = slice(start, min(start + group_size, num_boot))
+        w[group], n_log_lik[group], n_iter[group], converged[group] = _em_weights_group(w[group],
+                    Y_indv_pdf, X_indv_pdf, counts[group], tol=tol, max_iter=max_iter, acceleration=acceleration)
+
+    return w, n_log_lik, n_iter, converged
+
+
+def _em_weights_group(w, Y_indv_pdf, X_indv_pdf, counts, tol, max_iter, acceleration):
+    '''
+    Batched EM updates for a group of resamples. See _em_weights_batch().
+    '''
+    num_boot = np.shape(w)[0]
+    k = np.shape(Y_indv_pdf)[1]
+    total = np.sum(counts, axis=1)[:,None]
+    floor = _likelihood_floor(Y_indv_pdf.dtype)
+
+    def log_lik_gradient(w, counts):
+        # Likelihood of each data point for each resample, and the gradient of the log likelihood.
+        YW = np.matmul(Y_indv_pdf[None,:,:], w.reshape(-1,k,k))
+        likelihood = np.maximum(np.einsum('bij,ij->bi', YW, X_indv_pdf), floor)
+        gradient = np.matmul(Y_indv_pdf.T[None,:,:] * (counts/likelihood)[:,None,:], X_indv_pdf)
+        return gradient.reshape(-1,k*k), -np.sum(counts*np.log(likelihood), axis=1)
+
+    gradient, n_log_lik = log_lik_gradient(w, counts)
+    n_iter = np.zeros(num_boot, dtype=int)
+    converged = np.zeros(num_boot, dtype=bool)
+    active = np.arange(num_boot)
+
+    for iteration in range(max_iter+1):
+        gap = np.max(gradient[active], axis=1) - np.sum(w[active]*gradient[active], axis=1)
+        converged[active] = gap <= tol
+        n_iter[active] = iteration
+        active = active[~converged[active]]
+        if len(active) == 0 or iteration == max_iter:
+            break
+
+        c = counts[active]
+        N = total[active]
+        w1 = w[active] * gradient[active] / N
+        if acceleration == 'squarem':
+            gradient_1, _ = log_lik_gradient(w1, c)
+            w2 = w1 * gradient_1 / N
+            gradient_2, n_log_lik_2 = log_lik_gradient(w2, c)
+
+            r = w1 - w[active]
+            v = w2 - w1 - r
+            r_norm = np.sqrt(np.sum(r*r, axis=1))
+            v_norm = np.sqrt(np.sum(v*v, axis=1))
+            # Step length, at least as long as two plain EM updates.
+            alpha = np.minimum(-r_norm / np.where(v_norm > 0, v_norm, np.inf), -1.)[:,None]
+            w_new = w[active] - 2*alpha*r + alpha**2*v
+            # Weights extrapolated below zero are shrunk instead of set to zero. See _em_weights().
+            w_new = np.where(w_new > 0, w_new, 1e-3*w[active])
+            w_new = w_new / np.sum(w_new, axis=1)[:,None]
+            gradient_new, _ = log_lik_gradient(w_new, c)
+            w_new = w_new * gradient_new / N
+            gradient_new, n_log_lik_new = log_lik_gradient(w_new, c)
+
+            # Fall back to the plain EM updates where the extrapolated step is worse.
+            worse = ~(n_log_lik_new <= n_log_lik_2)
+            w_new[worse] = w2[worse]
+            gradient_new[worse] = gradient_2[worse]
+            n_log_lik_new[worse] = n_log_lik_2[worse]
+        elif acceleration is None:
+            w_new = w1
+            gradient_new, n_log_lik_new = log_lik_gradient(w1, c)
+        else:
+            raise ValueError("acceleration must be 'squarem' or None")
+
+        w[active], gradient[active], n_log_lik[active] = w_new, gradient_new, n_log_lik_new
+
+    return w, n_log_lik, n_iter, converged
+
+
+def _neg_log_likelihood_hessp(w, v, Y_indv_pdf, X_indv_pdf, counts=None):
+    '''
+    Hessian of _neg_log_likelihood() times a vector v, from the factored C matrix.
+    sum(outer(y_i, x_i) * (y_i . V . x_i) / (y_i . W . x_i)**2)
+    '''
+    likelihood = _likelihood_per_point(w, Y_indv_pdf, X_indv_pdf)
+    likelihood = np.maximum(likelihood, _likelihood_floor(likelihood.dtype))
+    scale = _likelihood_per_point(v, Y_indv_pdf, X_indv_pdf) / likelihood**2
+    if counts is not None:
+        scale = scale * counts
+
+    if scipy.sparse.issparse(Y_indv_pdf):
+        Y_scaled = scipy.sparse.csr_matrix(Y_indv_pdf.multiply(scale[:,None]))
+    else:
+        Y_scaled = Y_indv_pdf * scale[:,None]
+
+    hessp = Y_scaled.T.dot(X_indv_pdf)
+    if scipy.sparse.issparse(hessp):
+        hessp = hessp.toarray()
+    return np.asarray(hessp, dtype=np.float64).flatten()
+
+
+def _likelihood_floor(dtype):
+    '''
+    Smallest likelihood used for a data point, to avoid taking the log of 0.
+    '''
+    return max(1e-300, np.finfo(dtype).tiny)
+
+
+def _rescale_indv_pdf(a_log_indv_pdf, dtype=np.float64):
+    '''
+    Given the log of the integrated beta densities, subtract the largest entry in each row and
+    exponentiate, so that the largest entry for each data point is 1. Since the row scales never
+    leave log space, rows which would underflow to zero in linear scale keep their shape.
+
+    OUTPUTS:
+        a_rescaled: Numpy array of the rescaled beta densities in dtype.
+        log_scale: Numpy array (float64) with the log of the scale for each row.
+            The log likelihood of the original rows is that of the rescaled rows plus log_scale.
+    '''
+    a_log_indv_pdf = np.asarray(a_log_indv_pdf, dtype=np.float64)
+    log_scale = np.max(a_log_indv_pdf, axis=1)
+    # Rows which are zero everywhere are left as they are
+    log_scale = np.where(np.isfinite(log_scale), log_scale, 0.)
+
+    a_rescaled = np.exp(a_log_indv_pdf - log_scale[:,None]).astype(dtype)
+
+    return a_rescaled, log_scale
+
+
+def _neg_log_likelihood_log(w, Y_log_indv_pdf, X_log_indv_pdf, counts=None):
+    '''
+    Negative log likelihood from the log of the integrated beta densities (see _rescale_indv_pdf()).
+    If counts is given, each data point is weighted by the number of times it is drawn.
+    '''
+    Y_indv_pdf, Y_log_scale = _rescale_indv_pdf(Y_log_indv_pdf)
+    X_indv_pdf, X_log_scale = _rescale_indv_pdf(X_log_indv_pdf)
+
+    likelihood = _likelihood_per_point(w, Y_indv_pdf, X_indv_pdf)
+    likelihood = np.maximum(likelihood, _likelihood_floor(likelihood.dtype))
+    log_likelihood = np.log(likelihood) + Y_log_scale + X_log_scale
+
+    if counts is None:
+        return -np.sum(log_likelihood)
+    return -np.dot(counts, log_likelihood)
+
+
+def _sparsify_indv_pdf(a_indv_pdf, threshold):
+    '''
+    Convert the integrated beta densities to a sparse (CSR) matrix, dropping the entries smaller
+    than threshold times the largest entry in that row.
+
+    OUTPUTS:
+        a_sparse: scipy.sparse.csr_matrix with the kept entries.
+        truncated: Numpy array with the fraction of each row's sum that was dropped.
+    '''
+    if scipy.sparse.issparse(a_indv_pdf):
+        return a_indv_pdf, np.zeros(a_indv_pdf.shape[0])
+
+    row_max = np.max(a_indv_pdf, axis=1, keepdims=True)
+    keep = a_indv_pdf >= threshold*row_max
+    # Always keep at least the largest entry in each row
+    keep[np.arange(len(a_indv_pdf)), np.argmax(a_indv_pdf, axis=1)] = True
+
+    row_sum = np.sum(a_indv_pdf, axis=1)
+    dropped = np.sum(np.where(keep, 0, a_indv_pdf), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        truncated = np.where(row_sum > 0, dropped/row_sum, 0)
+
+    return scipy.sparse.csr_matrix(np.where(keep, a_indv_pdf, 0)), truncated
+
+
 def _norm_pdf(a, loc, scale):
     '''
     Find the PDF for a normal distribution. Identical to scipy.stats.norm.pdf.
@@ -274,12 +1239,21 @@ def _norm_pdf(a, loc, scale):
     N = (a - loc)/scale
     return np.exp(-N*N/2)/(np.sqrt(2*np.pi))/scale
 
-def _int_gamma(a):
-    return scipy.math.factorial(a-1)
-
+def _log_norm_pdf(a, loc, scale):
+    '''
+    Log of _norm_pdf(), which does not underflow far from the mean.
+    '''
+    N = (a - loc)/scale
+    return -N*N/2 - np.log(np.sqrt(2*np.pi)*scale)
 
 def _beta_pdf(x,a,b):
-    f = (_int_gamma(a+b) * x**(a-1)*(1-x)**(b-1))/(_int_gamma(a)*_int_gamma(b))
+    '''
+    Find the PDF for a beta distribution with integer shape parameters a and b.
+    Uses beta_pdf_matrix() which is stable for large degrees.
+    '''
+    f = beta_pdf_matrix(x, deg=a+b-1, deg_vec=[a])[:,0]
+    if np.ndim(x) == 0:
+        return f[0]
     return f
 
 
@@ -323,17 +1297,266 @@ def _find_indv_pdf(a, deg, deg_vec, a_max, a_min, a_std=np.nan, abs_tol=1e-8, Lo
     CHECK'''
 
 
-    if np.isnan(a_std):
+    if a_std is None or np.isnan(a_std):
         if Log:
-            a_std = (np.log10(a) - a_min)/(a_max - a_min)
+            a_scaled = (np.log10(a) - a_min)/(a_max - a_min)
         else:
-            a_std = (a - a_min)/(a_max - a_min)
-        a_beta_indv = np.array([_beta_pdf(a_std, a=d, b=deg - d + 1)/(a_max - a_min) for d in deg_vec])
+            a_scaled = (a - a_min)/(a_max - a_min)
+        a_beta_indv = beta_pdf_matrix(a_scaled, deg=deg, deg_vec=deg_vec)[0]/(a_max - a_min)
     else:
         a_beta_indv = np.array([integrate_function(data=a, data_std=a_std, deg=deg, degree=d, a_max=a_max, a_min=a_min, abs_tol=abs_tol, Log=Log) for d in deg_vec])
     return a_beta_indv
 
 
+def _integration_limits(a_obs, a_std, a_max, a_min, Log=True, n_sigma=12):
+    '''
+    Find the interval within [a_min, a_max] where the normal distribution of each data point is non-negligible.
+    Beyond n_sigma standard deviations the integrand is smaller than abs_tol for any practical degree.
+    '''
+    lower = a_obs - n_sigma*a_std
+    upper = a_obs + n_sigma*a_std
+
+    if Log == True:
+        lo = np.full(np.shape(a_obs), a_min, dtype=float)
+        positive = lower > 0
+        lo[positive] = np.maximum(np.log10(lower[positive]), a_min)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hi = np.minimum(np.log10(upper), a_max)
+    else:
+        lo = np.maximum(lower, a_min)
+        hi = np.minimum(upper, a_max)
+
+    return lo, hi
+
+
+def _integrate_norm_beta_batch(a_obs, a_std, deg, deg_vec, a_max, a_min, Log=True, abs_tol=1e-8,
+                                n_nodes=20, max_level=8, chunk_size=2**21, return_log=False):
+    '''
+    Integrate the product of the normal and beta distribution for an array of data points
+    and all the degrees in deg_vec at once. Vectorized counterpart of integrate_function().
+
+    Uses composite Gauss-Legendre quadrature with n_nodes per panel, restricted to the region
+    where the normal distribution is non-negligible. The number of panels is doubled for the
+    points which have not converged, until the difference between successive estimates is below
+    max(abs_tol, 1e-8*|integral|), or 2**max_level panels are reached.
+    The quadrature sums are evaluated in log space (logsumexp over the nodes), so integrals
+    far below the smallest float64 are kept as log values instead of underflowing to zero.
+
+    Refer to Ning et al. 2018 Sec 2.2, Eq 8.
+
+    \nINPUTS:
+        a_obs: Numpy array of measurements. In LINEAR SCALE if Log=True.
+        a_std: Numpy array of measurement uncertainties.
+        deg: Degree used for beta densities
+        deg_vec: Vector of degrees (shape1 parameters) to integrate for.
+        a_max, a_min: Maximum and minimum value. Log10 if Log=True.
+        Log: If True, the beta densities are in Log10 space while the measurements are linear.
+        abs_tol: Absolute tolerance for the integration.
+        n_nodes: Number of Gauss-Legendre nodes per panel.
+        max_level: Maximum number of panel doublings.
+        chunk_size: Maximum number of elements in the (points x nodes x degrees) integrand array.
+        return_log: If True, return the log of the integrals. Default=False.
+
+    OUTPUTS:
+        integrals: Numpy array of shape (len(a_obs), len(deg_vec)). Log values if return_log=True.
+        error: Numpy array with the estimated absolute error for each data point.
+    '''
+    a_obs = np.asarray(a_obs, dtype=float)
+    a_std = np.asarray(a_std, dtype=float)
+    n = np.size(a_obs)
+    n_deg = np.size(deg_vec)
+
+    log_integrals = np.full((n, n_deg), -np.inf)
+    error = np.zeros(n)
+
+    lo, hi = _integration_limits(a_obs, a_std, a_max, a_min, Log=Log)
+    # Points whose normal distribution lies outside the bounds contribute nothing.
+    active = np.where(hi > lo)[0]
+
+    nodes, node_weights = np.polynomial.legendre.leggauss(n_nodes)
+
+    def _composite(idx, n_panels):
+        # Log of the integral estimate using n_panels Gauss-Legendre panels for the data points in idx
+        result = np.zeros((len(idx), n_deg))
+        n_points = n_panels*n_nodes
+        step = max(1, chunk_size//(n_points*n_deg))
+
+        for start in range(0, len(idx), step):
+            sub = idx[start:start+step]
+            width = (hi[sub] - lo[sub])/n_panels
+            left = lo[sub][:,None] + width[:,None]*np.arange(n_panels)
+            x = (left[:,:,None] + width[:,None,None]*(nodes + 1)/2).reshape(len(sub), n_points)
+            w = np.tile(node_weights, n_panels)[None,:] * width[:,None]/2
+
+            if Log == True:
+                log_norm = _log_norm_pdf(a_obs[sub][:,None], loc=10**x, scale=a_std[sub][:,None])
+            else:
+                log_norm = _log_norm_pdf(a_obs[sub][:,None], loc=x, scale=a_std[sub][:,None])
+
+            t = (x - a_min)/(a_max - a_min)
+            log_beta = beta_pdf_matrix(t.ravel(), deg=deg, deg_vec=deg_vec, return_log=True).reshape(len(sub), n_points, n_deg)
+
+            with np.errstate(divide='ignore'):
+                result[start:start+step] = logsumexp((log_norm + np.log(w))[:,:,None] + log_beta, axis=1) - np.log(a_max - a_min)
+
+        return result
+
+    n_panels = 1
+    previous = _composite(active, n_panels)
+
+    for level in range(max_level):
+        if len(active) == 0:
+            break
+        n_panels *= 2
+        current = _composite(active, n_panels)
+
+        err = np.max(np.abs(np.exp(current) - np.exp(previous)), axis=1)
+        log_integrals[active] = current
+        error[active] = err
+
+        tol = np.maximum(abs_tol, 1e-8*np.max(np.exp(current), axis=1))
+        unconverged = err > tol
+        active = active[unconverged]
+        previous = current[unconverged]
+
+    if return_log:
+        return log_integrals, error
+    return np.exp(log_integrals), error
+
+
+def _find_indv_pdf_batch(a, deg, deg_vec, a_max, a_min, a_std=None, abs_tol=1e-8, Log=True, cores=1, cache_dir=None,
+                        return_log=False):
+    '''
+    Find the individual probability density Function for an array of data points.
+    Vectorized counterpart of _find_indv_pdf().
+    Data points without uncertainty (a_std = NaN) use the beta densities directly, the rest are
+    integrated using _integrate_norm_beta_batch().
+    If cores > 1, the data points are split into chunks across a process pool (_find_indv_pdf_parallel()).
+    If cache_dir is given, rows already in the on-disk cache are loaded from it, and only the
+    remaining data points are integrated and then added to the cache.
+    Repeated (a, a_std) pairs, eg. from bootstrap resamples, are only integrated once.
+    Everything is computed (and cached) as log values, and only exponentiated if return_log=False.
+
+    Refer to Ning et al. 2018 Sec 2.2, Eq 8.
+
+    OUTPUTS:
+        a_beta_indv: Numpy array of shape (len(a), len(deg_vec)). Log values if return_log=True.
+        error: Numpy array with the estimated absolute integration error for each data point.
+    '''
+    a = np.asarray(a, dtype=float)
+    if a_std is None:
+        a_std = np.full(np.shape(a), np.nan)
+    a_std = np.asarray(a_std, dtype=float)
+
+    # NaN never compares equal, so use a sentinel that no uncertainty can take
+    pairs = np.column_stack([a, np.where(np.isnan(a_std), -np.inf, a_std)])
+    _, unique_idx, inverse = np.unique(pairs, axis=0, return_index=True, return_inverse=True)
+
+    if len(unique_idx) < np.size(a):
+        log_indv, error = _find_indv_pdf_batch(a[unique_idx], deg, deg_vec, a_max, a_min, a_std=a_std[unique_idx],
+                                            abs_tol=abs_tol, Log=Log, cores=cores, cache_dir=cache_dir, return_log=True)
+        log_indv, error = log_indv[np.ravel(inverse)], error[np.ravel(inverse)]
+
+    elif cache_dir is not None:
+        keys = _basis_cache_keys(a, a_std, deg=deg, deg_vec=deg_vec, a_max=a_max, a_min=a_min, abs_tol=abs_tol, Log=Log)
+        cached = _load_cached_rows(cache_dir, keys)
+        missing = np.array([row is None for row in cached], dtype=bool)
+
+        log_indv = np.full((np.size(a), np.size(deg_vec)), -np.inf)
+        error = np.zeros(np.size(a))
+        # Each cached row holds the log integrated beta densities followed by the error estimate.
+        for i in np.where(~missing)[0]:
+            log_indv[i], error[i] = cached[i][:-1], cached[i][-1]
+
+        if np.any(missing):
+            log_indv[missing], error[missing] = _find_indv_pdf_batch(a[missing], deg, deg_vec, a_max, a_min,
+                                                        a_std=a_std[missing], abs_tol=abs_tol, Log=Log, cores=cores,
+                                                        return_log=True)
+            _save_cached_rows(cache_dir, [k for k, m in zip(keys, missing) if m],
+                            np.column_stack([log_indv[missing], error[missing]]))
+
+    elif cores > 1 and np.size(a) >= 2*cores:
+        log_indv, error = _find_indv_pdf_parallel(a, deg, deg_vec, a_max, a_min, a_std=a_std, abs_tol=abs_tol,
+                                                Log=Log, cores=cores)
+
+    else:
+        log_indv = np.full((np.size(a), np.size(deg_vec)), -np.inf)
+        error = np.zeros(np.size(a))
+
+        no_sigma = np.isnan(a_std)
+        if np.any(no_sigma):
+            if Log:
+                a_scaled = (np.log10(a[no_sigma]) - a_min)/(a_max - a_min)
+            else:
+                a_scaled = (a[no_sigma] - a_min)/(a_max - a_min)
+            log_indv[no_sigma] = beta_pdf_matrix(a_scaled, deg=deg, deg_vec=deg_vec, return_log=True) - np.log(a_max - a_min)
+
+        if np.any(~no_sigma):
+            log_indv[~no_sigma], error[~no_sigma] = _integrate_norm_beta_batch(a[~no_sigma], a_std[~no_sigma],
+                                                        deg=deg, deg_vec=deg_vec, a_max=a_max, a_min=a_min,
+                                                        Log=Log, abs_tol=abs_tol, return_log=True)
+
+    if return_log:
+        return log_indv, error
+    return np.exp(log_indv), error
+
+
+# Shared output arrays for the worker processes of _find_indv_pdf_parallel()
+_shared_indv_pdf = {}
+
+
+def _init_shared_indv_pdf(indv_pdf, error, shape):
+    _shared_indv_pdf['indv_pdf'] = indv_pdf
+    _shared_indv_pdf['error'] = error
+    _shared_indv_pdf['shape'] = shape
+
+
+def _find_indv_pdf_parallel(a, deg, deg_vec, a_max, a_min, a_std, abs_tol=1e-8, Log=True, cores=2, chunks_per_core=4):
+    '''
+    Split the data points into chunks and integrate them across a process pool.
+    Each worker writes its rows directly into a preallocated shared array, so the
+    results are not pickled back to the parent process.
+
+    OUTPUTS:
+        Same as _find_indv_pdf_batch() with return_log=True.
+    '''
+    n = np.size(a)
+    shape = (n, np.size(deg_vec))
+
+    indv_pdf = RawArray('d', shape[0]*shape[1])
+    error = RawArray('d', n)
+
+    chunks = [c for c in np.array_split(np.arange(n), cores*chunks_per_core) if len(c) > 0]
+    inputs = ((c[0], c[-1]+1, a[c], a_std[c], deg, deg_vec, a_max, a_min, abs_tol, Log) for c in chunks)
+
+    pool = Pool(processes=cores, initializer=_init_shared_indv_pdf, initargs=(indv_pdf, error, shape))
+    try:
+        _ = list(pool.imap_unordered(_find_indv_pdf_chunk, inputs))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return np.frombuffer(indv_pdf).reshape(shape).copy(), np.frombuffer(error).copy()
+
+
+def _find_indv_pdf_chunk(inputs):
+    '''
+    Integrate one chunk of data points and write it into the shared output arrays.
+    Serves as input to the parallelizing function in _find_indv_pdf_parallel().
+    '''
+    start, stop, a, a_std, deg, deg_vec, a_max, a_min, abs_tol, Log = inputs
+
+    indv_pdf = np.frombuffer(_shared_indv_pdf['indv_pdf']).reshape(_shared_indv_pdf['shape'])
+    error = np.frombuffer(_shared_indv_pdf['error'])
+
+    indv_pdf[start:stop], error[start:stop] = _find_indv_pdf_batch(a, deg, deg_vec, a_max, a_min, a_std=a_std,
+                                                abs_tol=abs_tol, Log=Log, return_log=True)
+    return start
+
+
 def _marginal_density(a, a_max, a_min, deg, w_hat):
     '''
     Calculate the marginal density
@@ -343,12 +1566,13 @@ def _marginal_density(a, a_max, a_min, deg, w_hat):
     if type(a) == list:
         a = np.array(a)
 
-    deg_vec = np.arange(1,deg+1)
-    x_beta_indv = _find_indv_pdf(a,deg, deg_vec, a_max, a_min)
-    x__beta_pdf = np.kron(x_beta_indv, np.repeat(1,deg))
+    x_beta_indv = beta_pdf_matrix((np.log10(a) - a_min)/(a_max - a_min), deg=deg)/(a_max - a_min)
 
-    marg_x = np.sum(w_hat * x__beta_pdf)
+    # Sum the weights over the other axis, equivalent to w_hat * np.kron(x_beta_indv, np.repeat(1,deg))
+    marg_x = np.matmul(x_beta_indv, np.sum(np.reshape(w_hat,(deg,deg)), axis=1))
 
+    if np.ndim(a) == 0:
+        return marg_x[0]
     return marg_x
 
 def cond_density_quantile(a, a_max, a_min, b_max, b_min, deg, deg_vec, w_hat, a_std=np.nan, qtl=[0.16,0.84], abs_tol=1e-8):
@@ -382,47 +1606,283 @@ def cond_density_quantile(a, a_max, a_min, b_max, b_min, deg, deg_vec, w_hat, a_
     var = var_numerator / denominator
 
     # Quantile
+    AW = np.matmul(np.reshape(w_hat, (np.max(deg_vec), np.max(deg_vec))), a_beta_indv)[None,:]
+    quantile = list(_conditional_quantiles(AW, np.atleast_1d(denominator), np.atleast_1d(qtl)[None,:],
+                                        deg=deg, deg_vec=deg_vec, b_max=b_max, b_min=b_min)[0])
+
+    return mean, var, quantile, denominator, a_beta_indv
+
+
+def cond_density_quantile_batch(a, a_max, a_min, b_max, b_min, deg, deg_vec, w_hat, a_std=np.nan, qtl=[0.16,0.84],
+                                abs_tol=1e-8, xtol=1e-8, grid_size=1024, polish=True):
+    '''
+    Vectorized cond_density_quantile() for an array of conditioning values.
+    The beta densities for all the conditioning values are evaluated as one matrix A (m x deg), and
+    the weights are contracted with it once, AW[i,j] = sum_k W[j,k] A[i,k], so the denominators,
+    means and variances are matrix vector products. The quantiles are found for all the conditioning
+    values at once by inverting the conditional CDF on a grid. See _conditional_quantiles().
+
+    Refer to Ning et al. 2018 Sec 2.2, Eq 10
 
-    def pbeta_conditional_density(j):
-        if type(j) == np.ndarray:
-            j = j[0]
-        b_indv_cdf = np.array([beta.cdf((j - b_min)/(b_max - b_min), a=d, b=deg - d + 1) for d in deg_vec])
-        quantile_numerator = np.sum(w_hat * np.kron(b_indv_cdf,a_beta_indv))
-        p_beta = quantile_numerator / denominator
+    INPUTS:
+        a: Numpy array of m conditioning values.
+        a_max, a_min: Bounds of the conditioning variable.
+        b_max, b_min: Bounds of the conditioned variable.
+        deg: Degree used for beta densities.
+        deg_vec: Vector of shape1 parameters.
+        w_hat: Padded weights (deg**2), with the conditioned variable as the first (slow) axis.
+        a_std: Uncertainty of the conditioning values (scalar or array of m values). NaN or None for none.
+        qtl: Quantiles to find, either a list used for every conditioning value, or an array of shape
+            (m, number of quantiles) with the quantiles for each conditioning value.
+        abs_tol: Absolute tolerance for the integration over a_std.
+        xtol: Absolute tolerance for the quantiles, if polish=True. Default=1e-8.
+        grid_size: Number of grid intervals for the conditional CDF. Default=1024.
+        polish: If True, refine the interpolated quantiles with Newton steps. Default=True.
+    OUTPUTS:
+        mean: Numpy array of m conditional means.
+        var: Numpy array of m conditional variances.
+        quantile: Numpy array of shape (m, number of quantiles).
+        denominator: Numpy array of m marginal densities at a. The denominator, mean, variance and
+            quantiles are NaN where the marginal density is 0, eg. at the bounds.
+        a_beta_indv: Numpy array of shape (m, len(deg_vec)) with the beta densities at a.
+    '''
+    a = np.atleast_1d(np.asarray(a, dtype=float))
+    if a_std is None:
+        a_std = np.nan
+    a_std = np.broadcast_to(np.asarray(a_std, dtype=float), np.shape(a))
+    deg_vec = np.asarray(deg_vec)
 
-        return p_beta
+    a_beta_indv = _find_indv_pdf_batch(a, deg, deg_vec, a_max, a_min, a_std=a_std, abs_tol=abs_tol, Log=False)[0]
+    AW = np.matmul(a_beta_indv, np.reshape(w_hat, (np.size(deg_vec), np.size(deg_vec))).T)
 
+    # Equation 10b Ning et al 2018
+    denominator = np.sum(AW, axis=1)
+    denominator = np.where(denominator == 0, np.nan, denominator)
 
-    def conditional_quantile(q):
-        def g(x):
-            return pbeta_conditional_density(x) - q
-        return root(g, a=b_min, b=b_max, xtol=1e-8, rtol=1e-12)
+    mean_beta_indv = (deg_vec * (b_max - b_min) / (deg + 1)) + b_min
+    var_beta_indv = (deg_vec * (deg - deg_vec + 1) * (b_max - b_min)**2 / ((deg + 2)*(deg + 1)**2))
+    mean = np.matmul(AW, mean_beta_indv) / denominator
+    var = np.matmul(AW, var_beta_indv) / denominator
 
+    qtl = np.asarray(qtl, dtype=float)
+    if qtl.ndim < 2:
+        qtl = np.broadcast_to(np.atleast_1d(qtl), (np.size(a), np.size(qtl)))
 
-    if np.size(qtl) == 1:
-        qtl = [qtl]
-    quantile = [conditional_quantile(i) for i in qtl]
+    quantile = _conditional_quantiles(AW, denominator, qtl, deg=deg, deg_vec=deg_vec, b_max=b_max, b_min=b_min,
+                                    xtol=xtol, grid_size=grid_size, polish=polish)
 
     return mean, var, quantile, denominator, a_beta_indv
 
 
-def calculate_joint_distribution(X_points, X_min, X_max, Y_points, Y_min, Y_max, weights, abs_tol):
+def _conditional_quantiles(AW, denominator, qtl, deg, deg_vec, b_max, b_min, xtol=1e-8, grid_size=1024,
+                        polish=True, max_newton=20, max_elements=_QUANTILE_BLOCK_ELEMENTS):
+    '''
+    Quantiles of the conditional densities sum_j AW[i,j] * beta_j(b) / denominator[i].
+    The conditional CDFs (sums of the beta CDFs from beta_cdf_matrix()) are evaluated on one uniform grid
+    over [b_min, b_max] as a matrix product, and each quantile is found by linear interpolation between the
+    grid points that bracket it. If polish=True, Newton steps using the conditional density refine each
+    quantile until the step is below xtol, staying inside its bracket.
+    The rows are processed in blocks, so the memory used does not grow with m.
+
+    INPUTS:
+        AW: Numpy array (m x len(deg_vec)) with the weights contracted with the conditioning beta densities.
+        denominator: Numpy array of m normalizations (sums of the rows of AW).
+        qtl: Numpy array (m x number of quantiles) of the quantiles to find for each row.
+        deg, deg_vec: Degree and shape1 parameters of the beta densities.
+        b_max, b_min: Bounds of the conditioned variable.
+        xtol: Absolute tolerance for the Newton steps. Default=1e-8.
+        grid_size: Number of grid intervals. Default=1024.
+        polish: If True, use Newton steps after the interpolation. Default=True.
+        max_newton: Maximum number of Newton steps. Default=20.
+        max_elements: Maximum size of the temporary arrays for each block of rows, which are
+            (rows x grid_size+1) and (rows x number of quantiles x len(deg_vec)). Default=_QUANTILE_BLOCK_ELEMENTS.
+    OUTPUT:
+        quantile: Numpy array (m x number of quantiles). NaN for rows where denominator is NaN or 0.
+    '''
+    deg_vec = np.asarray(deg_vec)
+    qtl = np.asarray(qtl, dtype=float)
+
+    t_grid = np.linspace(0, 1, grid_size + 1)
+    beta_cdf_grid = beta_cdf_matrix(t_grid, deg=deg, deg_vec=deg_vec).T
+
+    block_size = max(1, int(max_elements // max(grid_size + 1, np.shape(qtl)[1]*np.size(deg_vec))))
+
+    quantile = np.empty(np.shape(qtl))
+    for start in range(0, np.shape(qtl)[0], block_size):
+        block = slice(start, start + block_size)
+        quantile[block] = _conditional_quantiles_block(AW[block], denominator[block], qtl[block], deg=deg,
+                                deg_vec=deg_vec, b_max=b_max, b_min=b_min, t_grid=t_grid, beta_cdf_grid=beta_cdf_grid,
+                                xtol=xtol, polish=polish, max_newton=max_newton)
+    return quantile
+
+
+def _conditional_quantiles_block(AW, denominator, qtl, deg, deg_vec, b_max, b_min, t_grid, beta_cdf_grid,
+                                xtol, polish, max_newton):
+    '''
+    Quantiles for one block of rows. See _conditional_quantiles().
+    beta_cdf_grid is the transposed output of beta_cdf_matrix() on t_grid.
+    '''
+    width = b_max - b_min
+    grid_size = np.size(t_grid) - 1
+
+    # Conditional CDF of every row on the grid, which is non decreasing along each row
+    cdf_grid = np.matmul(AW, beta_cdf_grid) / denominator[:,None]
+    cdf_grid = np.maximum.accumulate(np.clip(cdf_grid, 0, 1), axis=1)
+
+    rows = np.arange(np.shape(qtl)[0])[:,None]
+    # Index of the grid interval containing each quantile
+    upper = np.array([np.searchsorted(cdf_row, qtl_row) for cdf_row, qtl_row in zip(cdf_grid, qtl)], dtype=int)
+    upper = np.clip(np.reshape(upper, np.shape(qtl)), 1, grid_size)
+    lower = upper - 1
+    cdf_lower, cdf_upper = cdf_grid[rows, lower], cdf_grid[rows, upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(cdf_upper > cdf_lower, (qtl - cdf_lower)/(cdf_upper - cdf_lower), 0.5)
+    t = (lower + np.clip(fraction, 0, 1))/grid_size
+
+    if polish:
+        t_lower, t_upper = t_grid[lower], t_grid[upper]
+        for i in range(max_newton):
+            flat_t = t.ravel()
+            flat_rows = np.broadcast_to(rows, np.shape(t)).ravel()
+            cdf = np.sum(AW[flat_rows] * beta_cdf_matrix(flat_t, deg=deg, deg_vec=deg_vec), axis=1) / denominator[flat_rows]
+            pdf = np.sum(AW[flat_rows] * beta_pdf_matrix(flat_t, deg=deg, deg_vec=deg_vec), axis=1) / denominator[flat_rows]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                step = np.where(pdf > 0, (cdf - qtl.ravel())/pdf, 0).reshape(np.shape(t))
+            # Keep the steps inside the bracket from the grid, where the CDF is monotone
+            t_new = np.clip(t - step, t_lower, t_upper)
+            converged = np.all(~(np.abs(t_new - t)*width > xtol))
+            t = t_new
+            if converged:
+                break
+
+    quantile = b_min + t*width
+    # No conditional density where the marginal density is zero
+    quantile[~(denominator > 0)] = np.nan
+    return quantile
+
+
+def calculate_joint_distribution(X_points, X_min, X_max, Y_points, Y_min, Y_max, weights, abs_tol=1e-8):
     '''
     Calculcate the joint distribution of Y and X (Y and X) : f(y,x|w,d,d')
     Refer to Ning et al. 2018 Sec 2.1, Eq 7
+
+    The beta densities are evaluated once for all the points, as the matrices B_y (len(Y_points) x deg)
+    and B_x (len(X_points) x deg), and the joint density on the grid is the matrix product B_y W B_x^T,
+    where W are the weights reshaped to (deg, deg) with Y as the first axis.
+
+    INPUTS:
+        X_points, Y_points: Numpy arrays of points (Log10) at which to evaluate the joint distribution.
+            Any number of points can be used, eg. 1000 each for publication quality plots.
+        X_min, X_max, Y_min, Y_max: Bounds for X and Y.
+        weights: Padded weights (deg**2).
+        abs_tol: Not used, kept for backward compatibility.
+    OUTPUT:
+        joint: Numpy array of shape (len(Y_points), len(X_points)) with the joint density.
     '''
 
     deg = int(np.sqrt(len(weights)))
     deg_vec = np.arange(1,deg+1)
 
-    joint = np.zeros((len(X_points), len(Y_points)))
+    X_beta_indv = beta_pdf_matrix((np.asarray(X_points) - X_min)/(X_max - X_min), deg=deg, deg_vec=deg_vec)/(X_max - X_min)
+    Y_beta_indv = beta_pdf_matrix((np.asarray(Y_points) - Y_min)/(Y_max - Y_min), deg=deg, deg_vec=deg_vec)/(Y_max - Y_min)
+
+    joint = np.matmul(np.matmul(Y_beta_indv, np.reshape(weights,(deg,deg))), X_beta_indv.T)
+
+    return joint
+
+
+def calculate_joint_distribution_boot(weights_boot, X_points, X_min, X_max, Y_points, Y_min, Y_max, filename,
+                                    qtl=[0.5,0.16,0.84], tile_size=128, boot_chunk=100):
+    '''
+    Per pixel summary statistics of the joint distribution of Y and X over the bootstrap fits,
+    eg. the median and a credible band for the joint density.
+    The grid is split into tiles of tile_size x tile_size pixels. For each tile the joint density of every
+    bootstrap is B_y W_b B_x^T (see calculate_joint_distribution()), with the bootstrap weights read
+    boot_chunk rows at a time, and the quantiles over the bootstraps are written to a memory mapped
+    .npy file. So the full (num_boot x len(Y_points) x len(X_points)) array is never in memory, and the
+    peak memory is about num_boot * tile_size**2 values.
+
+    INPUTS:
+        weights_boot: Numpy array (or memory mapped array) of padded bootstrap weights (num_boot x deg**2),
+            or the path to weights_boot.txt from fit_xy_relation(). The text file is copied, boot_chunk
+            rows at a time, to a temporary binary file next to filename.
+        X_points, Y_points: Numpy arrays of points (Log10) at which to evaluate the joint distribution.
+        X_min, X_max, Y_min, Y_max: Bounds for X and Y.
+        filename: Path of the .npy file for the output.
+        qtl: Quantiles over the bootstraps to find for each pixel. Default=[0.5,0.16,0.84].
+        tile_size: Number of pixels along each side of a tile. Default=128.
+        boot_chunk: Number of bootstrap weights read at a time. Default=100.
+    OUTPUT:
+        joint_boot: Memory mapped numpy array of shape (len(qtl), len(Y_points), len(X_points)), with the
+            quantiles of the joint density for each pixel. Also saved in filename (np.load(filename, mmap_mode='r')).
+    '''
+    store_dir = None
+    if isinstance(weights_boot, str):
+        store_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+        weights_boot = _text_to_memmap(weights_boot, os.path.join(store_dir, 'weights_boot.npy'), boot_chunk)
+
+    try:
+        num_boot, n_weights = np.shape(weights_boot)
+        deg = int(np.sqrt(n_weights))
+        deg_vec = np.arange(1,deg+1)
+
+        X_beta_indv = beta_pdf_matrix((np.asarray(X_points) - X_min)/(X_max - X_min), deg=deg, deg_vec=deg_vec)/(X_max - X_min)
+        Y_beta_indv = beta_pdf_matrix((np.asarray(Y_points) - Y_min)/(Y_max - Y_min), deg=deg, deg_vec=deg_vec)/(Y_max - Y_min)
+
+        joint_boot = np.lib.format.open_memmap(filename, mode='w+', dtype=float,
+                                            shape=(np.size(qtl), len(Y_beta_indv), len(X_beta_indv)))
 
-    for i in range(len(X_points)):
-        for j in range(len(Y_points)):
-                    x_beta_indv = _find_indv_pdf(a=X_points[i], deg=deg, deg_vec=deg_vec, a_max=X_max, a_min=X_min, a_std=np.nan, abs_tol=abs_tol, Log=False)
-                    y_beta_indv = _find_indv_pdf(a=Y_points[j], deg=deg, deg_vec=deg_vec, a_max=Y_max, a_min=Y_min, a_std=np.nan, abs_tol=abs_tol, Log=False)
+        for y_start in range(0, len(Y_beta_indv), tile_size):
+            Y_tile = Y_beta_indv[y_start:y_start+tile_size]
+            for x_start in range(0, len(X_beta_indv), tile_size):
+                X_tile = X_beta_indv[x_start:x_start+tile_size]
 
-                    intermediate = np.matmul(np.reshape(weights,(deg,deg)),np.matrix(x_beta_indv).T)
-                    joint[i,j] = np.matmul(np.matrix(y_beta_indv), intermediate)
+                tile = np.empty((num_boot, len(Y_tile), len(X_tile)))
+                for b_start in range(0, num_boot, boot_chunk):
+                    W = np.reshape(weights_boot[b_start:b_start+boot_chunk], (-1, deg, deg))
+                    tile[b_start:b_start+boot_chunk] = np.matmul(np.matmul(Y_tile, W), X_tile.T)
 
-    return joint.T
+                joint_boot[:, y_start:y_start+len(Y_tile), x_start:x_start+len(X_tile)] = np.percentile(tile,
+                                                                            np.multiply(qtl, 100), axis=0)
+        joint_boot.flush()
+    finally:
+        if store_dir is not None:
+            del weights_boot
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    return joint_boot
+
+
+def _text_to_memmap(text_file, filename, chunk_size):
+    '''
+    Copy a 2D array saved with np.savetxt() to a memory mapped .npy file, chunk_size rows at a time.
+
+    INPUTS:
+        text_file: Path of the text file.
+        filename: Path of the .npy file.
+        chunk_size: Number of rows parsed at a time.
+    OUTPUT:
+        array: Memory mapped numpy array (read only).
+    '''
+    def rows():
+        with open(text_file, 'r') as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    yield line
+
+    n_rows = sum(1 for _ in rows())
+    n_columns = len(next(rows()).split())
+
+    array = np.lib.format.open_memmap(filename, mode='w+', dtype=float, shape=(n_rows, n_columns))
+    chunk, start = [], 0
+    for line in rows():
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            array[start:start+len(chunk)] = np.loadtxt(chunk, ndmin=2)
+            start, chunk = start + len(chunk), []
+    if chunk:
+        array[start:start+len(chunk)] = np.loadtxt(chunk, ndmin=2)
+    array.flush()
+    del array
+
+    return np.load(filename, mmap_mode='r')
@@ -6,6 +6,8 @@ import os
 from scipy.stats.mstats import mquantiles
 from astropy.table import Table
 
+from .mle_utils import calculate_joint_distribution
+
 
 def plot_y_given_x_relation(result_dir):
     """
@@ -289,7 +291,7 @@ def plot_yx_and_xy(result_dir):
     return fig, ax1, handles
 
 
-def plot_joint_xy_distribution(result_dir):
+def plot_joint_xy_distribution(result_dir, grid_size=None):
     """
     Use to plot joint distribution of mass AND radius.
     Fig 3 (b,d) from Kanodia et al. 2019
@@ -297,6 +299,9 @@ def plot_joint_xy_distribution(result_dir):
     \nINPUTS:
         result_dir : Directory generated by the fitting function.
             Example: result_dir = '~/mrexo_working/trial_result'
+        grid_size : If None, plot output/joint_distribution.txt. Else, recompute the joint
+            distribution from output/weights.txt with grid_size points along each axis
+            (or a tuple of (number of X points, number of Y points)), eg. 1000 for publication plots.
 
     EXAMPLE:
 
@@ -335,7 +340,13 @@ def plot_joint_xy_distribution(result_dir):
     logY_sigma = 0.434 * Y_sigma/Y
     logX_sigma = 0.434 * X_sigma/X
 
-    joint = np.loadtxt(os.path.join(output_location,'joint_distribution.txt'))
+    if grid_size is None:
+        joint = np.loadtxt(os.path.join(output_location,'joint_distribution.txt'))
+    else:
+        X_size, Y_size = np.broadcast_to(grid_size, 2).astype(int)
+        weights = np.loadtxt(os.path.join(output_location,'weights.txt'))
+        joint = calculate_joint_distribution(np.linspace(X_min, X_max, X_size), X_min, X_max,
+                                        np.linspace(Y_min, Y_max, Y_size), Y_min, Y_max, weights)
 
     fig = plt.figure(figsize=(8.5,6.5))
     ax1 = fig.add_subplot(1,1,1)
@@ -6,13 +6,16 @@ import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from multiprocessing import Pool,cpu_count
 
-from .mle_utils import cond_density_quantile
+from .mle_utils import cond_density_quantile, cond_density_quantile_batch
 from .utils import _load_lookup_table
 from .plot import plot_x_given_y_relation, plot_y_given_x_relation
 
 pwd = os.path.dirname(__file__)
 np.warnings.filterwarnings('ignore')
 
+# Number of rows of the lookup table computed in each call to _lookup_table_chunk()
+_LOOKUP_CHUNK_ROWS = 50
+
 def predict_from_measurement(measurement, measurement_sigma=np.nan,
             predict = 'mass', result_dir=None, dataset='mdwarf',
             is_posterior=False, qtl=[0.16,0.84], show_plot=False,
@@ -233,14 +236,14 @@ def predict_from_measurement(measurement, measurement_sigma=np.nan,
                 print('Error: Trying to use lookup table when it does not exist. Run script to generate lookup table or set use_lookup = False.')
 
         if not lookup_flag:
-            for i in range(0,n):
-                qtl_check = np.random.random()
+            # A random quantile for each sample of the posterior, all found at once
+            qtl_check = np.random.random((n, 1))
 
-                results = cond_density_quantile(a=log_measurement[i], a_std=None, a_max=measurement_max, a_min=measurement_min,
-                                                        b_max=predict_max, b_min=predict_min, deg=degree, deg_vec = deg_vec,
-                                                        w_hat=w_hat, qtl=[qtl_check])
+            results = cond_density_quantile_batch(a=log_measurement, a_std=None, a_max=measurement_max, a_min=measurement_min,
+                                                    b_max=predict_max, b_min=predict_min, deg=degree, deg_vec = deg_vec,
+                                                    w_hat=w_hat, qtl=qtl_check)
 
-                random_quantile[i] = results[2][0]
+            random_quantile = results[2][:,0]
 
         outputs = [random_quantile]
 
@@ -359,18 +362,32 @@ def generate_lookup_table(predict = 'Mass', result_dir = None, cores = 1):
         fname = 'lookup_x_given_y'
         comment = 'Lookup table for predicting log({}) given log({}) and certain quantile.'.format(X_label, Y_label)
 
+    weights_mle = np.loadtxt(os.path.join(output_location,'weights.txt'))
+    degree = int(np.sqrt(len(weights_mle)))
+
+    if predict_quantity==Y_label:
+        w_hat = weights_mle
+        bounds = (X_min, X_max, Y_min, Y_max)
+    else:
+        w_hat = np.reshape(weights_mle,(degree,degree)).T.flatten()
+        bounds = (Y_min, Y_max, X_min, X_max)
+
+    # Each row of the table holds all the quantiles for one value of the measurement,
+    # found together for a chunk of rows with cond_density_quantile_batch().
+    # The marginal density can be zero at the bounds, so the first and last rows are the limits from inside.
+    eps = 1e-9 * (bounds[1] - bounds[0])
+    # The chunks have a fixed number of rows, so the memory used does not depend on the number of cores.
+    search_steps = np.clip(search_steps, bounds[0] + eps, bounds[1] - eps)
+    lookup_inputs = [(search_steps[i:i+_LOOKUP_CHUNK_ROWS], qtl_steps, bounds, degree, w_hat)
+                    for i in range(0, lookup_grid_size, _LOOKUP_CHUNK_ROWS)]
+
     if cores <= 1:
-        lookup_table = np.zeros((lookup_grid_size, lookup_grid_size))
-        for i in range(0,lookup_grid_size):
-            lookup_table[i,:] = np.log10(predict_from_measurement(measurement = 10**search_steps[i], qtl = qtl_steps,
-                                result_dir = result_dir, predict = predict_quantity)[1])
-            if i%100==0:
-                print(i)
+        lookup_table = np.vstack([_lookup_table_chunk(inputs) for inputs in lookup_inputs])
     else:
-        lookup_inputs = ((10**search_steps[i], qtl_steps, result_dir, predict_quantity) for i in range(lookup_grid_size))
         pool = Pool(processes=cores)
-        lookup_table = list(pool.imap(lookup_table_parallelize,lookup_inputs))
-
+        lookup_table = np.vstack(pool.map(_lookup_table_chunk, lookup_inputs))
+        pool.close()
+        pool.join()
 
     np.savetxt(os.path.join(output_location,fname+'.txt'), lookup_table, comments='#', header=comment)
 
@@ -381,3 +398,20 @@ def generate_lookup_table(predict = 'Mass', result_dir = None, cores = 1):
 def lookup_table_parallelize(inputs):
     return np.log10(predict_from_measurement(measurement = inputs[0], qtl = inputs[1],
                                 result_dir = inputs[2], predict = inputs[3])[1])
+
+
+def _lookup_table_chunk(inputs):
+    """
+    Rows of the lookup table for a chunk of measurements, in log10 units.
+    \nINPUTS:
+        inputs: Tuple of (log10 measurements, quantiles, (measurement_min, measurement_max, predict_min, predict_max),
+                degree, w_hat), with w_hat ordered with the predicted quantity first.
+    OUTPUT:
+        lookup_table: Numpy array of shape (number of measurements, number of quantiles).
+    """
+    search_steps, qtl_steps, bounds, degree, w_hat = inputs
+    measurement_min, measurement_max, predict_min, predict_max = bounds
+
+    return cond_density_quantile_batch(a=search_steps, a_max=measurement_max, a_min=measurement_min,
+                                        b_max=predict_max, b_min=predict_min, deg=degree, deg_vec=np.arange(1,degree+1),
+                                        w_hat=w_hat, qtl=qtl_steps)[2]
@@ -0,0 +1,213 @@
+import numpy as np
+import time
+from scipy.optimize import fmin_slsqp, minimize, Bounds, LinearConstraint
+
+
+def minimize_weights(objective, gradient, x0, solver='slsqp', options=None, hessp=None, callback=None,
+                    record_trace=False):
+    """
+    Minimize an objective over the weights of the beta densities, which lie on the simplex
+    (each weight between 0 and 1, and the weights summing to 1).
+    The solvers are listed in SOLVERS, and all of them use the same inputs and outputs,
+    so they can be swapped and benchmarked against each other.
+
+    INPUTS:
+        objective: Function of the weights to minimize, eg. the negative log likelihood.
+        gradient: Function returning the gradient of objective.
+        x0: Initial weights.
+        solver: Name of the solver. Default='slsqp'.
+            'slsqp': Sequential least squares (scipy.optimize.fmin_slsqp).
+            'trust-constr': Trust region Newton method for constrained problems (scipy.optimize.minimize).
+                Uses hessp if given, else a quasi-Newton (BFGS) Hessian.
+            'em': Expectation maximization (multiplicative) updates for mixture weights, with
+                SQUAREM acceleration. Only valid when objective is a negative log likelihood
+                which is linear in the weights for each data point. See _solve_em().
+        options: Dictionary of keyword arguments for the solver. Default=None. See the _solve_* functions.
+        hessp: Function hessp(w, v) returning the Hessian of objective at w times a vector v.
+            Only used by 'trust-constr'. Default=None.
+        callback: Function called after each iteration as callback(iteration, objective, duality_gap, wall_time).
+            Default=None.
+        record_trace: If True, record the objective value, duality gap and wall time at every iteration.
+            This costs one extra evaluation of objective and gradient per iteration. Default=False.
+            With g the gradient of objective at the weights w, the duality gap is w.g - min(g). It is zero
+            exactly at a minimum on the simplex (for a convex objective like the negative log likelihood
+            it bounds how far objective is above its minimum), unlike the norm of g which does not vanish
+            at a constrained minimum.
+    OUTPUTS:
+        x: Weights at the minimum.
+        fun: Objective at x.
+        n_iter: Number of iterations.
+        exit_code: 0 if the solver converged, else a solver specific code.
+        message: Message from the solver.
+        trace: Numpy array with a row for each iteration, and columns for the iteration number,
+            objective, duality gap and wall time (s) since the start. Empty if record_trace is False
+            and callback is None.
+
+    EXAMPLE:
+        x, fun, n_iter, exit_code, message, trace = minimize_weights(objective, gradient, x0,
+                                                        solver='trust-constr', record_trace=True)
+    """
+    if solver not in SOLVERS:
+        raise ValueError('solver must be one of {}'.format(sorted(SOLVERS)))
+    if options is None:
+        options = {}
+
+    trace = []
+    starttime = time.time()
+
+    def iteration_callback(w):
+        g = gradient(w)
+        entry = (len(trace) + 1, objective(w), np.dot(w, g) - np.min(g), time.time() - starttime)
+        trace.append(entry)
+        if callback is not None:
+            callback(*entry)
+
+    solver_callback = iteration_callback if (record_trace or callback is not None) else None
+
+    if solver == 'trust-constr':
+        options = dict(options, hessp=hessp)
+
+    x, fun, n_iter, exit_code, message = SOLVERS[solver](objective, gradient, np.asarray(x0, dtype=float),
+                                                iteration_callback=solver_callback, **options)
+
+    return x, fun, n_iter, exit_code, message, np.reshape(np.array(trace, dtype=float), (-1,4))
+
+
+def _solve_slsqp(objective, gradient, x0, iteration_callback=None, iter=250, acc=1e-5, epsilon=1e-5, iprint=1):
+    """
+    Sequential least squares programming. The defaults are the ones MLE_fit() has always used.
+    """
+    n = np.size(x0)
+
+    # Ensure that the weights always sum up to 1.
+    def eqn(w):
+        return np.sum(w) - 1
+
+    # Jacobian of the equality constraint, which is constant.
+    def eqn_jacobian(w):
+        return np.ones((1, n))
+
+    # Define a list of lists of bounds
+    bounds = [[0,1]]*n
+
+    opt_result = fmin_slsqp(objective, x0, fprime=gradient, bounds=bounds, f_eqcons=eqn, fprime_eqcons=eqn_jacobian,
+                            iter=iter, acc=acc, epsilon=epsilon, iprint=iprint, full_output=True,
+                            callback=iteration_callback)
+    return opt_result[0], opt_result[1], opt_result[2], opt_result[3], opt_result[4]
+
+
+def _solve_trust_constr(objective, gradient, x0, iteration_callback=None, hessp=None, maxiter=1000,
+                        gtol=1e-8, xtol=1e-10, verbose=0):
+    """
+    Trust region method for constrained problems (scipy.optimize.minimize(method='trust-constr')),
+    with the sum to one constraint as a linear constraint and the weights bounded by [0, 1].
+    With the exact Hessian vector product (hessp) this is a Newton method.
+    """
+    n = np.size(x0)
+
+    if iteration_callback is not None:
+        def trust_callback(w, state):
+            iteration_callback(w)
+            return False
+    else:
+        trust_callback = None
+
+    if hessp is None:
+        from scipy.optimize import BFGS
+        hess = BFGS()
+    else:
+        hess = None
+
+    # Start strictly inside the bounds, which the interior point method requires.
+    x0 = np.clip(x0, 1e-10, 1)
+    x0 = x0 / np.sum(x0)
+
+    res = minimize(objective, x0, method='trust-constr', jac=gradient, hess=hess, hessp=hessp,
+                bounds=Bounds(np.zeros(n), np.ones(n)),
+                constraints=[LinearConstraint(np.ones((1, n)), 1, 1)],
+                options={'maxiter':maxiter, 'gtol':gtol, 'xtol':xtol, 'verbose':verbose},
+                callback=trust_callback)
+
+    # Remove the round off from the interior point method.
+    x = np.clip(res.x, 0, 1)
+    x = x / np.sum(x)
+    return x, objective(x), res.nit, 0 if res.success else res.status, res.message
+
+
+def _solve_em(objective, gradient, x0, iteration_callback=None, tol=1e-6, max_iter=10000, acceleration='squarem'):
+    """
+    Expectation maximization for mixture weights.
+    The objective has to be a negative log likelihood sum_i -log(w . c_i), where c_i are the
+    (integrated) basis densities for data point i. With g the gradient of the log likelihood,
+    the fixed point update is
+        w <- w * g / (w . g)
+    where w . g is the number of data points. Each update does not decrease the likelihood,
+    keeps the weights non-negative and summing to 1.
+
+    The log likelihood is concave in the weights, so max(g) - w.g is an upper bound on how far the
+    log likelihood at w is below its maximum on the simplex. This duality gap is the stopping criterion.
+
+    Refer to Varadhan & Roland 2008 (SQUAREM, scheme S3) for the acceleration.
+
+    INPUTS:
+        tol: Stop when the duality gap is smaller than tol. Default=1e-6.
+        max_iter: Maximum number of iterations. Each SQUAREM iteration uses three EM updates.
+        acceleration: 'squarem' or None.
+    """
+    def em_update(w, g=None):
+        if g is None:
+            g = -gradient(w)
+        return w * g / np.dot(w, g)
+
+    w = np.asarray(x0, dtype=float)
+    w = w / np.sum(w)
+    n_log_lik = objective(w)
+    converged = False
+
+    for n_iter in range(max_iter+1):
+        g = -gradient(w)
+        if np.max(g) - np.dot(w, g) <= tol:
+            converged = True
+            break
+        if n_iter == max_iter:
+            break
+
+        w1 = em_update(w, g)
+        if acceleration == 'squarem':
+            w2 = em_update(w1)
+            r = w1 - w
+            v = w2 - w1 - r
+            v_norm = np.sqrt(np.dot(v, v))
+            n_log_lik_2 = objective(w2)
+            if v_norm > 0:
+                # Step length, at least as long as two plain EM updates.
+                alpha = min(-np.sqrt(np.dot(r, r)) / v_norm, -1.)
+                w_new = w - 2*alpha*r + alpha**2*v
+                # Weights extrapolated below zero are shrunk instead of set to zero, since the EM updates
+                # can never move a weight away from exactly zero.
+                w_new = np.where(w_new > 0, w_new, 1e-3*w)
+                w_new = em_update(w_new / np.sum(w_new))
+                n_log_lik_new = objective(w_new)
+                # Fall back to the plain EM updates if the extrapolated step is worse.
+                if not n_log_lik_new <= n_log_lik_2:
+                    w_new, n_log_lik_new = w2, n_log_lik_2
+            else:
+                w_new, n_log_lik_new = w2, n_log_lik_2
+        elif acceleration is None:
+            w_new = w1
+            n_log_lik_new = objective(w1)
+        else:
+            raise ValueError("acceleration must be 'squarem' or None")
+
+        w, n_log_lik = w_new, n_log_lik_new
+        if iteration_callback is not None:
+            iteration_callback(w)
+
+    message = 'Converged' if converged else 'Reached max_iter = {}'.format(max_iter)
+    return w, n_log_lik, n_iter, int(not converged), message
+
+
+# Solvers available to minimize_weights() and MLE_fit()
+SOLVERS = {'slsqp': _solve_slsqp,
+           'trust-constr': _solve_trust_constr,
+           'em': _solve_em}
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import hashlib
 from multiprocessing import current_process
 import sys
 if sys.version_info.major==3:
@@ -137,3 +138,156 @@ def _logging(message, filepath, verbose, append=True):
         print('Using core '+message)
 
     return 1
+
+
+# Maximum size of the on-disk cache of integrated beta densities, in bytes.
+_BASIS_CACHE_MAX_BYTES = 2**30
+
+
+def _basis_cache_keys(a, a_std, deg, deg_vec, a_max, a_min, abs_tol, Log):
+    """
+    Content based keys for the on-disk cache of integrated beta densities, one per data point.
+    The key depends on the measurement, its uncertainty, the bounds, the degree,
+    the beta densities being integrated, the Log flag and the integration tolerance.
+    INPUT:
+        a, a_std: Numpy arrays of measurements and their uncertainties.
+        Rest are the same as _find_indv_pdf_batch() in mle_utils.
+    OUTPUT:
+        keys: List of hex digest strings.
+    """
+    common = np.array([a_max, a_min, abs_tol, float(Log), deg], dtype=float).tobytes() + np.asarray(deg_vec, dtype=float).tobytes()
+    point = np.stack([np.asarray(a, dtype=float), np.asarray(a_std, dtype=float)], axis=1)
+    # Same bytes for every NaN
+    point[np.isnan(point)] = np.nan
+
+    return [hashlib.sha1(b'indv_pdf_v2' + common + p.tobytes()).hexdigest() for p in point]
+
+
+def _load_cached_rows(cache_dir, keys):
+    """
+    Load cached rows from cache_dir. The cache holds one file of rows for each batch of data points
+    that was saved together, named by the hash of the batch, and a file with the key of each of its rows.
+    Batches with any loaded rows are touched to mark them as recently used.
+    INPUT:
+        cache_dir: Directory of the cache.
+        keys: List of keys from _basis_cache_keys().
+    OUTPUT:
+        rows: List with the cached Numpy array for each key, or None if it is not in the cache.
+    """
+    rows = [None]*len(keys)
+    location = _cache_locations(cache_dir)
+
+    wanted = {}
+    for j, key in enumerate(keys):
+        if key in location:
+            batch, i = location[key]
+            wanted.setdefault(batch, []).append((j, i))
+
+    for batch, pairs in wanted.items():
+        path = os.path.join(cache_dir, batch+'.npy')
+        try:
+            batch_rows = np.load(path, mmap_mode='r')
+            for j, i in pairs:
+                rows[j] = np.array(batch_rows[i])
+            del batch_rows
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return rows
+
+
+def _cache_locations(cache_dir):
+    """
+    Batch and row index for every key in cache_dir, as a dictionary keyed by the key.
+    Only the key files are read.
+    """
+    location = {}
+    if not os.path.isdir(cache_dir):
+        return location
+
+    for batch in _cached_batches(cache_dir):
+        try:
+            batch_keys = np.load(os.path.join(cache_dir, batch+'_keys.npy'))
+        except (IOError, OSError, ValueError):
+            continue
+        location.update((k.decode(), (batch, i)) for i, k in enumerate(batch_keys))
+    return location
+
+
+def _save_cached_rows(cache_dir, keys, rows, max_bytes=None):
+    """
+    Save rows to cache_dir as one batch, and evict the least recently used batches if the cache exceeds max_bytes.
+    The batch is two files, <batch hash>.npy with the rows and <batch hash>_keys.npy with the key of each row,
+    so the number of files does not grow with the number of data points.
+    INPUT:
+        cache_dir: Directory of the cache. Created if it does not exist.
+        keys: List of keys from _basis_cache_keys().
+        rows: Numpy array (or list) with one row per key.
+        max_bytes: Maximum size of the cache in bytes. Default=None, uses _BASIS_CACHE_MAX_BYTES.
+    OUTPUT:
+        Returns nothing.
+    """
+    if len(keys) == 0:
+        return
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    batch = hashlib.sha1(''.join(keys).encode()).hexdigest()
+    # The rows are written before the keys, so a batch is only found once both files are complete.
+    for name, array in [(batch+'.npy', np.asarray(rows, dtype=float)),
+                        (batch+'_keys.npy', np.array(keys, dtype='S40'))]:
+        path = os.path.join(cache_dir, name)
+        # Write to a temporary file first, so that other processes never read a partial file.
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        _replace_file(tmp_path, path)
+
+    _evict_cache(cache_dir, max_bytes=_BASIS_CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+
+def _replace_file(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists.
+    os.rename replaces dst atomically on POSIX, but fails on Windows if dst exists.
+    """
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def _cached_batches(cache_dir):
+    """
+    Names (hashes) of the batches in cache_dir.
+    """
+    return [name[:-len('_keys.npy')] for name in os.listdir(cache_dir) if name.endswith('_keys.npy')]
+
+
+def _evict_cache(cache_dir, max_bytes):
+    """
+    Delete the least recently used batches in cache_dir until it is smaller than max_bytes.
+    """
+    entries = []
+    for batch in _cached_batches(cache_dir):
+        paths = [os.path.join(cache_dir, batch+'.npy'), os.path.join(cache_dir, batch+'_keys.npy')]
+        try:
+            stats = [os.stat(path) for path in paths]
+        except OSError:
+            continue
+        entries.append((stats[0].st_mtime, stats[0].st_size + stats[1].st_size, paths))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, paths in sorted(entries):
+        if total <= max_bytes:
+            break
+        # Remove the keys first, so a partly removed batch is never found
+        for path in paths[::-1]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size